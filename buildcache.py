@@ -0,0 +1,137 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+# A store of LLVM toolchains copied from build directories, so that a build of
+# a commit can be reused after the build directory moved to another commit.
+# An entry is <store>/<key>/{bin,lib,include,info.json}, where key is from
+# toolchainKey. Least recently used entries are evicted when the store gets
+# larger than its limit.
+
+# Key of a toolchain built from commit with cmakeargs (without the source
+# directory) by the host compiler identified by compilerid.
+def toolchainKey(commit, cmakeargs, compilerid):
+  js = json.dumps({"commit": commit, "cmake": cmakeargs, "compiler": compilerid},
+                  sort_keys=True)
+  return hashlib.sha1(js.encode("utf-8")).hexdigest()[:20]
+
+def _dirSize(path):
+  size = 0
+  for dp, dn, filenames in os.walk(path):
+    for f in filenames:
+      try:
+        size = size + os.lstat(os.path.join(dp, f)).st_size
+      except OSError:
+        pass
+  return size
+
+# Copies clang and tools that test-suite needs from an LLVM build directory.
+# If src (the source directory) is given, llvm-config, static libraries and
+# headers are copied as well, so that programs can be built against LLVM.
+def copyToolchain(builddir, dest, src=None):
+  tmp = "%s.%d" % (dest, os.getpid())
+  shutil.rmtree(tmp, ignore_errors=True)
+  os.makedirs(os.path.join(tmp, "bin"))
+  os.makedirs(os.path.join(tmp, "lib"))
+  tools = ["llvm-size", "llvm-dis", "llvm-lit", "llvm-config", "lld", "ld.lld"]
+  for f in os.listdir(os.path.join(builddir, "bin")):
+    if f in tools or re.match(r"^clang(-[0-9]+)?(\+\+)?$", f):
+      shutil.copy2(os.path.join(builddir, "bin", f), os.path.join(tmp, "bin", f),
+                   follow_symlinks=False)
+  libdir = os.path.join(builddir, "lib")
+  for f in os.listdir(libdir):
+    if f == "clang":
+      # Headers of clang
+      shutil.copytree(os.path.join(libdir, f), os.path.join(tmp, "lib", f),
+                      symlinks=True)
+    elif ".so" in f or f.endswith(".dylib") or (src and f.endswith(".a")):
+      # Shared libraries if LLVM was built with sharedlib
+      shutil.copy2(os.path.join(libdir, f), os.path.join(tmp, "lib", f),
+                   follow_symlinks=False)
+  if src:
+    # llvm-config outside of the build directory finds headers and libraries
+    # at ../include and ../lib like an installed LLVM
+    ignore = shutil.ignore_patterns("CMakeFiles", "*.cmake", "*.txt")
+    for d in [os.path.join(src, "llvm", "include"), os.path.join(builddir, "include")]:
+      for f in ["llvm", "llvm-c"]:
+        if os.path.isdir(os.path.join(d, f)):
+          shutil.copytree(os.path.join(d, f), os.path.join(tmp, "include", f),
+                          ignore=ignore, dirs_exist_ok=True)
+  os.replace(tmp, dest)
+
+class ToolchainStore(object):
+  def __init__(self, root, maxsize):
+    self.root = root
+    self.maxsize = maxsize
+    os.makedirs(root, exist_ok=True)
+
+  def _lock(self):
+    f = open(os.path.join(self.root, ".lock"), "w")
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+  # Returns the path of the toolchain of key, or None if it is not stored
+  # (or does not have headers and libraries although dev is True).
+  def lookup(self, key, dev=False):
+    path = os.path.join(self.root, key)
+    infopath = os.path.join(path, "info.json")
+    if not os.path.exists(infopath):
+      return None
+    if dev and not json.load(open(infopath, "r"))["dev"]:
+      return None
+    # The modification time of info.json is the last time it was used
+    os.utime(infopath)
+    return path
+
+  # Copies the toolchain at builddir to the store as key (see copyToolchain
+  # for src), and evicts old entries. info is stored at info.json.
+  # Returns the path of the entry.
+  def add(self, key, builddir, info, src=None):
+    path = os.path.join(self.root, key)
+    tmp = os.path.join(self.root, ".%s.%d" % (key, os.getpid()))
+    copyToolchain(builddir, tmp, src)
+    js = dict(info)
+    js["dev"] = src != None
+    js["size"] = _dirSize(tmp)
+    js["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    json.dump(js, open(os.path.join(tmp, "info.json"), "w"), indent=1)
+
+    with self._lock():
+      if os.path.exists(path):
+        old = os.path.join(self.root, ".%s.old.%d" % (key, os.getpid()))
+        os.replace(path, old)
+        shutil.rmtree(old, ignore_errors=True)
+      os.replace(tmp, path)
+      self._evict(key)
+    return path
+
+  # Returns a list of (key, info) from the most recently used one.
+  def entries(self):
+    res = []
+    for key in os.listdir(self.root):
+      infopath = os.path.join(self.root, key, "info.json")
+      if key.startswith(".") or not os.path.exists(infopath):
+        continue
+      info = json.load(open(infopath, "r"))
+      info["last-used"] = os.path.getmtime(infopath)
+      res.append((key, info))
+    res.sort(key=lambda e: -e[1]["last-used"])
+    return res
+
+  # Removes least recently used entries except keep until the store fits in
+  # maxsize. The lock should be held.
+  def _evict(self, keep):
+    entries = self.entries()
+    total = sum([info["size"] for key, info in entries])
+    while total > self.maxsize and len(entries) > 0:
+      key, info = entries.pop()
+      if key == keep:
+        continue
+      print("Removing toolchain %s (%s) from %s" %
+            (key, info["commit"][:12] if info.get("commit") else "?", self.root))
+      shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+      total = total - info["size"]
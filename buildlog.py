@@ -0,0 +1,148 @@
+import bisect
+import datetime
+import json
+import math
+import os
+
+# Analyzes .ninja_log of a build directory. Build logs are stored at
+# <build dir>/.llvmscript-buildlog/<time>.json .
+BUILDLOG_DIR = ".llvmscript-buildlog"
+
+# Returns (inode, size) of .ninja_log at builddir, which is given to
+# readNinjaLog after building to read the entries of the build only.
+def ninjaLogPosition(builddir):
+  path = os.path.join(builddir, ".ninja_log")
+  if not os.path.exists(path):
+    return None
+  st = os.stat(path)
+  return (st.st_ino, st.st_size)
+
+# Reads entries of the last build from .ninja_log at builddir.
+# If position (from ninjaLogPosition before building) is given and the log
+# was not recompacted since then, the entries appended after it are read;
+# if ninja ran several times since then, the runs are laid out one after
+# another. Otherwise, the last build is the entries since the end time
+# decreases.
+# Returns a list of (start sec, end sec, [outputs]).
+def readNinjaLog(builddir, position=None):
+  path = os.path.join(builddir, ".ninja_log")
+  if not os.path.exists(path):
+    return []
+  f = open(path, "r")
+  appended = position != None and os.fstat(f.fileno()).st_ino == position[0]
+  if appended:
+    f.seek(position[1])
+  lines = f.readlines()
+  f.close()
+
+  entries = []
+  lastend = -1
+  base = 0
+  for l in lines:
+    if l.startswith("#"):
+      continue
+    fields = l.rstrip("\n").split("\t")
+    if len(fields) < 5:
+      continue
+    start, end, output, cmdhash = int(fields[0]), int(fields[1]), fields[3], fields[4]
+    if end < lastend:
+      # A new run of ninja starts
+      if appended:
+        base = base + lastend
+      else:
+        entries = []
+    lastend = end
+    entries.append((base + start, base + end, output, cmdhash))
+
+  # Outputs of one command have the same command hash and times
+  edges = dict()
+  for start, end, output, cmdhash in entries:
+    edges.setdefault((start, end, cmdhash), []).append(output)
+  return sorted([(k[0] / 1000, k[1] / 1000, outs) for k, outs in edges.items()])
+
+def _targetKind(output):
+  if output.endswith(".o") or output.endswith(".obj"):
+    return "compile"
+  base = os.path.basename(output)
+  if output.startswith("bin/") or base.endswith(".a") or ".so" in base or \
+     base.endswith(".dylib"):
+    return "link"
+  return "other"
+
+# An approximation of the critical path, made of the target that finished
+# last and, repeatedly, the target that finished last before the current one
+# started. Returns a list of indices of edges.
+def _criticalPath(edges):
+  if len(edges) == 0:
+    return []
+  byend = sorted(range(0, len(edges)), key=lambda i: edges[i][1])
+  ends = [edges[i][1] for i in byend]
+  path = [byend[-1]]
+  while True:
+    k = bisect.bisect_right(ends, edges[path[-1]][0]) - 1
+    if k < 0 or byend[k] in path:
+      break
+    path.append(byend[k])
+  path.reverse()
+  return path
+
+# Summarizes edges from readNinjaLog.
+def summarizeBuild(edges, buckets=60):
+  if len(edges) == 0:
+    return {"wall": 0.0, "cpu": 0.0, "parallelism": 0.0, "kinds": {},
+            "targets": [], "timeline": [], "critical-path": []}
+
+  begin = min([e[0] for e in edges])
+  wall = max([e[1] for e in edges]) - begin
+  cpu = sum([e[1] - e[0] for e in edges])
+
+  kinds = dict()
+  targets = []
+  for start, end, outs in edges:
+    name = outs[0]
+    kind = _targetKind(name)
+    k = kinds.setdefault(kind, {"count": 0, "cpu": 0.0})
+    k["count"] = k["count"] + 1
+    k["cpu"] = k["cpu"] + end - start
+    targets.append({"target": name, "kind": kind, "start": start - begin,
+                    "duration": end - start})
+  targets.sort(key=lambda t: -t["duration"])
+
+  # Average # of running jobs over time
+  width = max(wall / buckets, 1.0)
+  timeline = [0.0] * max(1, int(math.ceil(wall / width)))
+  for start, end, outs in edges:
+    s = start - begin
+    e = end - begin
+    b = int(s / width)
+    while b * width < e and b < len(timeline):
+      overlap = min(e, (b + 1) * width) - max(s, b * width)
+      timeline[b] = timeline[b] + overlap / width
+      b = b + 1
+
+  return {"wall": wall, "cpu": cpu,
+          "parallelism": cpu / wall if wall > 0 else 0.0,
+          "kinds": kinds, "targets": targets,
+          "timeline": [[b * width, v] for b, v in enumerate(timeline)],
+          "critical-path": [edges[i][2][0] for i in _criticalPath(edges)]}
+
+# Stores the summary of a build with info (cmake options, jobs, ...).
+# Returns the path of the stored log.
+def saveBuildLog(builddir, summary, info):
+  logdir = os.path.join(builddir, BUILDLOG_DIR)
+  os.makedirs(logdir, exist_ok=True)
+  now = datetime.datetime.now()
+  js = dict(info)
+  js["time"] = now.isoformat(timespec="seconds")
+  js["summary"] = summary
+  path = os.path.join(logdir, now.strftime("%Y%m%d-%H%M%S") + ".json")
+  json.dump(js, open(path, "w"), indent=1)
+  return path
+
+# Returns the paths of stored build logs at builddir, from the oldest one.
+def listBuildLogs(builddir):
+  logdir = os.path.join(builddir, BUILDLOG_DIR)
+  if not os.path.exists(logdir):
+    return []
+  return [os.path.join(logdir, f) for f in sorted(os.listdir(logdir))
+          if f.endswith(".json")]
@@ -1,17 +1,108 @@
 #!/bin/bash
+# Placeholders are replaced by _initCCScript at run.py.
+CLANG=[[CLANG]]
+PARAM="[[PARAM]]"         # Flags for emitting the side output (empty: none)
+EXT=[[EXT]]
+CACHEDIR="[[CACHEDIR]]"   # Compile cache (empty: disabled)
+CLANGHASH=[[CLANGHASH]]
+SINGLEPASS="[[SINGLEPASS]]" # Build the object from the side output (empty: disabled)
+OBJPARAM="[[OBJPARAM]]"     # Flags for building the object from the side output
+
 params=("$@")
 params2=( ) # -o updated
+keyparams=( ) # -o and dependency file options removed
 i2=0
 dest=
+compile=0
 for ((i=0; i < $#; i++)); do
   if [ "${params[i]}" == "-o" ]; then
     i=$((i+1))
     dest=${params[i]}
-  else
-    params2[i2]=${params[i]}
-    i2=$((i2+1))
+    continue
   fi
+
+  params2[i2]=${params[i]}
+  i2=$((i2+1))
+  case "${params[i]}" in
+    -c) compile=1; keyparams+=("${params[i]}");;
+    -MD|-MMD) ;;
+    -MF|-MT|-MQ)
+      i=$((i+1))
+      params2[i2]=${params[i]}
+      i2=$((i2+1));;
+    *) keyparams+=("${params[i]}");;
+  esac
+done
+
+# Arguments for building the object from the side output: sources, languages
+# and dependency file options are removed (and -g for assembly inputs).
+objparams=( )
+for ((i=0; i < ${#params2[@]}; i++)); do
+  a=${params2[i]}
+  case "$a" in
+    -x|-MF|-MT|-MQ) i=$((i+1));;
+    -MD|-MMD) ;;
+    -g*) [ "$EXT" != "s" ] && objparams+=("$a");;
+    -*) objparams+=("$a");;
+    *.c|*.cc|*.cpp|*.cxx|*.C|*.c++|*.m|*.mm|*.i|*.ii|*.s|*.S)
+      [ -f "$a" ] || objparams+=("$a");;
+    *) objparams+=("$a");;
+  esac
 done
 
-[[CLANG]] [[PARAM]] ${params2[@]} -o "${dest}.[[EXT]]"
-[[CLANG]] ${params[@]}
+build() {
+  if [ -z "$PARAM" ]; then
+    $CLANG "${params[@]}"
+    return $?
+  fi
+
+  $CLANG $PARAM "${params2[@]}" -o "${dest}.${EXT}"
+  res=$?
+  if [ -n "$SINGLEPASS" ] && [ $compile -eq 1 ] && [ -n "$dest" ] && [ $res -eq 0 ]; then
+    # Reuse the side output instead of running the frontend and optimizer again
+    $CLANG $OBJPARAM "${dest}.${EXT}" "${objparams[@]}" -Qunused-arguments \
+        -o "$dest" 2>/dev/null && return 0
+  fi
+  $CLANG "${params[@]}"
+}
+
+if [ -z "$CACHEDIR" ] || [ $compile -eq 0 ] || [ -z "$dest" ]; then
+  build
+  exit $?
+fi
+
+# The key of the compile cache is made of clang, the arguments, how the object
+# is built (objects of singlepass are built from the side output) and the
+# preprocessed source. Preprocessing also writes the dependency file if asked.
+ppargs=( )
+for a in "${params2[@]}"; do
+  [ "$a" != "-c" ] && ppargs+=("$a")
+done
+set -o pipefail
+pphash=$($CLANG -E "${ppargs[@]}" 2>/dev/null | sha256sum) || { build; exit $?; }
+key=$( { echo "$CLANGHASH"; echo "$PARAM"; echo "$EXT"; echo "$SINGLEPASS";
+         echo "$OBJPARAM"; printf '%s\n' "${keyparams[@]}";
+         echo "$pphash"; } | sha256sum | cut -d' ' -f1 )
+entry="$CACHEDIR/${key:0:2}/$key"
+
+if [ -f "$entry.o" ] && { [ -z "$PARAM" ] || [ -f "$entry.$EXT" ]; }; then
+  # The side output is copied first, so that it is complete once the object exists
+  if [ -n "$PARAM" ]; then
+    cp "$entry.$EXT" "${dest}.${EXT}" || { build; exit $?; }
+  fi
+  cp "$entry.o" "$dest" || { build; exit $?; }
+  touch "$entry.o"
+  exit 0
+fi
+
+build
+res=$?
+[ $res -ne 0 ] && exit $res
+
+mkdir -p "$CACHEDIR/${key:0:2}"
+if [ -n "$PARAM" ] && [ -f "${dest}.${EXT}" ]; then
+  cp "${dest}.${EXT}" "$entry.$EXT.$$" && mv "$entry.$EXT.$$" "$entry.$EXT"
+fi
+cp "$dest" "$entry.o.$$" && mv "$entry.o.$$" "$entry.o"
+
+exit 0
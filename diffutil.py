@@ -1,64 +1,250 @@
 import argparse
+import difflib
+import hashlib
+import json
+import multiprocessing
 import os
 import re
+import shutil
+import subprocess
 import sys
 
-def asmHasDiff(asmpath1, asmpath2):
-  prune = lambda s: (s if s.find("#") == -1 else s[s.find("#"):]).strip()
+# Name of the file that caches digests of normalized outputs in a directory
+DIGEST_INDEX = ".llvmscript-digests.json"
+# Version of the normalization; digests of other versions are recomputed
+DIGEST_VERSION = 2
 
-  asm1 = open(asmpath1, "r").readlines()
-  asm2 = open(asmpath2, "r").readlines()
+ASM_IDENT_PATTERN = re.compile('.ident\s*\"clang version [0-9]+.[0-9].[0-9] \(((git\@github.com)|(https:\/\/github.com))[a-zA-Z0-9\)\( :/.-]*')
+# !1 = !{!"clang version 11.0.0 (git@github.com:aqjune/llvm-project-nonnull.git 13db7490fa67e22605dec4ab824121230b0fd928)"}
+LL_IDENT_PATTERN = re.compile('\![0-9]+\s*=\s*\!\{\!\"clang version [0-9]+.[0-9].[0-9] \(((git\@github.com)|(https:\/\/github.com))[a-zA-Z0-9\)\( :/.-]*\"\}')
 
-  hasdiff = False
-  if len(asm1) != len(asm2):
-    hasdiff = True
-  else:
-    for i in range(0, len(asm1)):
-      a1 = prune(asm1[i])
-      a2 = prune(asm2[i])
-
-      if a1 == a2:
-        continue
-      elif a1.startswith(".ident") and a2.startswith(".ident"):
-        pattern = '.ident\s*\"clang version [0-9]+.[0-9].[0-9] \(((git\@github.com)|(https:\/\/github.com))[a-zA-Z0-9\)\( :/.-]*'
-        if re.match(pattern, a1) or re.match(pattern, a2):
-          continue
-        else:
-          hasdiff = True
-          break
-      else:
-        hasdiff = True
-        break
-  return hasdiff
+# Comments that clang emits at every function: "# -- Begin function f" on x86,
+# "//" on AArch64 ELF (where "#" starts an immediate), ";" on Darwin arm64 and
+# "@" on ARM.
+ASM_COMMENT_PATTERN = re.compile(r'^\s*(#|//|;|@)\s*(-- Begin function|-- End function|%bb\.)')
+
+# Returns the string that starts a comment in assembly lines ("#" if unknown).
+def asmCommentMarker(lines):
+  for l in lines:
+    m = ASM_COMMENT_PATTERN.match(l)
+    if m:
+      return m.group(1)
+  return "#"
+
+# Removes comments and the clang version from assembly lines.
+def normalizeAsm(lines):
+  res = []
+  marker = asmCommentMarker(lines)
+  for l in lines:
+    if l.find(marker) != -1:
+      l = l[:l.find(marker)]
+    l = l.strip()
+    if l.startswith(".ident") and ASM_IDENT_PATTERN.match(l):
+      l = ".ident"
+    res.append(l)
+  return res
+
+# Removes the module id and the clang version from LLVM IR lines.
+def normalizeLL(lines):
+  res = []
+  for l in lines[1:]:
+    l = l.strip()
+    if LL_IDENT_PATTERN.match(l):
+      l = "!clang version"
+    res.append(l)
+  return res
+
+def asmHasDiff(asmpath1, asmpath2):
+  asm1 = normalizeAsm(open(asmpath1, "r").readlines())
+  asm2 = normalizeAsm(open(asmpath2, "r").readlines())
+  return asm1 != asm2
 
 def llHasDiff(llpath1, llpath2):
-  ll1 = open(llpath1, "r").readlines()
-  ll2 = open(llpath2, "r").readlines()
+  ll1 = normalizeLL(open(llpath1, "r").readlines())
+  ll2 = normalizeLL(open(llpath2, "r").readlines())
+  return ll1 != ll2
+
+def _digest(lines):
+  h = hashlib.sha1()
+  for l in lines:
+    h.update(l.encode("utf-8", "surrogateescape"))
+    h.update(b"\n")
+  return h.hexdigest()
+
+# Loads the digest index of dir. Its entries are
+# relpath -> [size, mtime (ns), kind, digest].
+def loadDigestIndex(dir):
+  try:
+    js = json.load(open(os.path.join(dir, DIGEST_INDEX), "r"))
+  except (OSError, ValueError):
+    return dict()
+  if js.get("version", 1) != DIGEST_VERSION:
+    return dict()
+  return js["files"] if "files" in js else dict()
+
+def saveDigestIndex(dir, index):
+  path = os.path.join(dir, DIGEST_INDEX)
+  tmp = "%s.%d" % (path, os.getpid())
+  try:
+    with open(tmp, "w") as f:
+      json.dump({"version": DIGEST_VERSION, "files": index}, f)
+    os.replace(tmp, path)
+  except OSError as e:
+    print("Warning: cannot write %s (%s)" % (path, e))
+
+# Disassembles a bitcode file through a pipe. Returns None if failed.
+def disassemble(llvmdis, path):
+  p = subprocess.Popen([llvmdis, path, "-o", "-"], stdout=subprocess.PIPE)
+  out, err = p.communicate()
+  if p.returncode != 0:
+    print("Warning: cannot disassemble %s" % path)
+    return None
+  return out.decode("utf-8", "surrogateescape").splitlines()
 
-  hasdiff = False
-  if len(ll1) != len(ll2):
-    hasdiff = True
+# Computes the digest of a normalized file. This runs at worker processes.
+# kind is "asm" for assembly files, or "ll:<llvm-dis path>" for bitcode files.
+def _fileDigest(arg):
+  dir, f, kind = arg
+  path = os.path.join(dir, f)
+  st = os.stat(path)
+  if kind == "asm":
+    lines = open(path, "r", errors="surrogateescape").readlines()
+    d = _digest(normalizeAsm(lines))
+  elif kind.startswith("ll:"):
+    lines = disassemble(kind[len("ll:"):], path)
+    # A file that cannot be disassembled is always regarded as different.
+    d = _digest(normalizeLL(lines)) if lines != None else None
   else:
-    for i in range(1, len(ll1)):
-      a = ll1[i].strip()
-      b = ll2[i].strip()
-      if a != b:
-        # !1 = !{!"clang version 11.0.0 (git@github.com:aqjune/llvm-project-nonnull.git 13db7490fa67e22605dec4ab824121230b0fd928)"}
-        pat = '\![0-9]+\s*=\s*\!\{\!\"clang version [0-9]+.[0-9].[0-9] \(((git\@github.com)|(https:\/\/github.com))[a-zA-Z0-9\)\( :/.-]*\"\}'
-        if re.match(pat, a) or re.match(pat, b):
-          continue
-        hasdiff = True
-        break
-  return hasdiff
-
-def diffDirs(path1, path2, emitasm, outf):
+    assert False, "Unknown kind: %s" % kind
+  return (f, [st.st_size, st.st_mtime_ns, kind, d])
+
+# Returns the digests of files at dir, reading only the files whose size or
+# mtime differs from the ones recorded at the digest index of dir.
+def updateDigests(dir, files, kind, pool=None):
+  index = loadDigestIndex(dir)
+  todo = []
+  for f in files:
+    st = os.stat(os.path.join(dir, f))
+    e = index.get(f)
+    if e and e[0] == st.st_size and e[1] == st.st_mtime_ns and e[2] == kind:
+      continue
+    todo.append((dir, f, kind))
+
+  if len(todo) > 0:
+    print("Normalizing %d/%d files at %s" % (len(todo), len(files), dir))
+    itr = pool.imap_unordered(_fileDigest, todo, chunksize=16) if pool else \
+          map(_fileDigest, todo)
+    for f, e in itr:
+      index[f] = e
+    saveDigestIndex(dir, index)
+  return index
+
+# Splits normalized assembly lines into functions. Returns a dict from
+# function names to their instructions; labels and directives are dropped.
+# Lines that do not belong to any function are collected at key "".
+def splitAsmFunctions(lines):
+  funcs = set()
+  for l in lines:
+    # ELF: .type foo,@function
+    if l.startswith(".type") and \
+       (l.endswith("@function") or l.endswith("%function")):
+      funcs.add(l[len(".type"):].split(",")[0].strip())
+  # Mach-O has no .type directive; regard non-local labels as functions
+  nofuncinfo = len(funcs) == 0
+
+  res = {"": []}
+  cur = ""
+  for l in lines:
+    if l == "":
+      continue
+    if l.endswith(":") and l.find(" ") == -1:
+      label = l[:-1]
+      if label in funcs or \
+         (nofuncinfo and not label.startswith("L") and not label.startswith(".")):
+        cur = label
+        res[cur] = []
+      continue
+    if l.startswith(".size") and cur != "" and \
+       l[len(".size"):].split(",")[0].strip() == cur:
+      cur = ""
+      continue
+    if cur == "":
+      res[""].append(l)
+    elif not l.startswith("."):
+      res[cur].append(l)
+  return res
+
+# Compares functions of one pair of assembly files. This runs at worker
+# processes of diffDirs.
+def _funcDiffPair(arg):
+  path1, path2, f = arg
+  fns1 = splitAsmFunctions(normalizeAsm(open(os.path.join(path1, f), "r",
+                                             errors="surrogateescape").readlines()))
+  fns2 = splitAsmFunctions(normalizeAsm(open(os.path.join(path2, f), "r",
+                                             errors="surrogateescape").readlines()))
+  res = {"toplevel_changed": fns1[""] != fns2[""], "functions": {}}
+  del fns1[""]
+  del fns2[""]
+
+  for fn in sorted(set(fns1.keys()).union(fns2.keys())):
+    body1 = fns1.get(fn, [])
+    body2 = fns2.get(fn, [])
+    if fn in fns1 and fn in fns2 and body1 == body2:
+      continue
+
+    added = 0
+    removed = 0
+    sm = difflib.SequenceMatcher(None, body1, body2, autojunk=False)
+    for tag, i1, i2, j1, j2 in sm.get_opcodes():
+      if tag != "equal":
+        removed = removed + (i2 - i1)
+        added = added + (j2 - j1)
+
+    status = "changed"
+    if fn not in fns1:
+      status = "added"
+    elif fn not in fns2:
+      status = "removed"
+    res["functions"][fn] = {"status": status, "added": added,
+                            "removed": removed, "instrs1": len(body1),
+                            "instrs2": len(body2)}
+  return (f, res)
+
+# Relative paths of files with extension ext under path
+def _listFiles(path, ext):
+  return [os.path.join(os.path.relpath(dp, path), f)
+          for dp, dn, filenames in os.walk(path)
+          for f in filenames if os.path.splitext(f)[-1] == ext]
+
+def _digestKind(emitasm, llvmdis):
+  if emitasm:
+    return "asm"
+  return "ll:" + os.path.abspath(shutil.which(llvmdis) or llvmdis)
+
+# Updates the digest indices of two directories that are still being built.
+# Only the files that exist at both directories are updated; the compiler
+# wrapper emits a .s/.bc file before its object file, so a .s/.bc file is
+# complete if its object file exists.
+def warmDigests(path1, path2, emitasm, pool=None, llvmdis1="llvm-dis",
+                llvmdis2="llvm-dis"):
+  ext = '.s' if emitasm else '.bc'
+  _built = lambda path, f: os.path.exists(os.path.join(path, f[:-len(ext)]))
+  files = [f for f in _listFiles(path1, ext)
+           if _built(path1, f) and _built(path2, f) and
+              os.path.exists(os.path.join(path2, f))]
+  updateDigests(path1, files, _digestKind(emitasm, llvmdis1), pool)
+  updateDigests(path2, files, _digestKind(emitasm, llvmdis2), pool)
+
+# Diffs .s files (if emitasm is True) or .bc files at two directories and
+# writes the result to outf. .bc files are disassembled with llvmdis1 and
+# llvmdis2 respectively.
+# If funcdiff is given, changed functions of different assembly files are
+# written to funcdiff as a json file.
+def diffDirs(path1, path2, emitasm, outf, jobs=1, llvmdis1="llvm-dis",
+             llvmdis2="llvm-dis", funcdiff=None):
   ext = '.s' if emitasm else '.bc'
-  result1 = [os.path.join(os.path.relpath(dp, path1), f)
-              for dp, dn, filenames in os.walk(path1)
-              for f in filenames if os.path.splitext(f)[-1] == ext]
-  result2 = [os.path.join(os.path.relpath(dp, path2), f)
-              for dp, dn, filenames in os.walk(path2)
-              for f in filenames if os.path.splitext(f)[-1] == ext]
+  result1 = _listFiles(path1, ext)
+  result2 = _listFiles(path2, ext)
   # The list of files should be same
   set1 = set(result1)
   set2 = set(result2)
@@ -82,25 +268,43 @@ def diffDirs(path1, path2, emitasm, outf):
   print("Total %d %s pairs found" % (len(result1), ext))
   # TODO: relate 'tests' variable with results
 
+  result1.sort()
+
+  # Normalizing a file is independent from others, so spread them over a pool.
+  pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+
+  # Compare digests of the normalized files; a tree is normalized only once
+  # even if it is compared with many other trees.
+  index1 = updateDigests(path1, result1, _digestKind(emitasm, llvmdis1), pool)
+  index2 = updateDigests(path2, result1, _digestKind(emitasm, llvmdis2), pool)
+  itr = ((f, index1[f][3] == None or index1[f][3] != index2[f][3])
+         for f in result1)
+
   cnt = 0
-  for asmf in result1:
+  difffiles = []
+  for asmf, hasdiff in itr:
     cnt = cnt + 1
-    asmpath1 = "%s/%s" % (path1, asmf)
-    asmpath2 = "%s/%s" % (path2, asmf)
-    if emitasm:
-      hasdiff = asmHasDiff(asmpath1, asmpath2)
-    else:
-      tmp1 = "/tmp/%d.l.ll" % cnt
-      tmp2 = "/tmp/%d.r.ll" % cnt
-      p = Popen(["%s/bin/llvm-dis" % llvmdir1, asmpath1, "-o", tmp1])
-      p.wait()
-      p = Popen(["%s/bin/llvm-dis" % llvmdir2, asmpath2, "-o", tmp2])
-      p.wait()
-      hasdiff = llHasDiff(tmp1, tmp2)
     outf.write("%s %s\n" % (asmf, "YESDIFF" if hasdiff else "NODIFF"))
+    if hasdiff:
+      difffiles.append(asmf)
     if cnt % 100 == 0:
       print("--%d--" % cnt)
 
+  if funcdiff:
+    if not emitasm:
+      print("Warning: function-level diff is supported for assembly files only")
+    else:
+      pairs = [(path1, path2, f) for f in difffiles]
+      itr = pool.imap(_funcDiffPair, pairs, chunksize=4) if pool else \
+            map(_funcDiffPair, pairs)
+      json.dump({"files": dict(itr)}, open(funcdiff, "w"), indent=2,
+                sort_keys=True)
+      print("Function-level diff: %s" % funcdiff)
+
+  if pool:
+    pool.close()
+    pool.join()
+
 class DiffUtil:
   def __init__(self):
     parser = argparse.ArgumentParser(
@@ -128,16 +332,41 @@ Diffs assembly outputs from two directories.
     parser.add_argument('dir2', help='directory 2')
     parser.add_argument('--out', help='Output file path', required=True,
                         action='store')
+    parser.add_argument('--jobs', help='# of processes to use', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--funcdiff', action='store',
+                        help='Write changed functions to this json file')
     args = parser.parse_args(sys.argv[2:])
 
     testpath1 = args.dir1
     testpath2 = args.dir2
     print(testpath1)
     print(testpath2)
-    diffDirs(testpath1, testpath2, True, open(args.out, "w"))
+    diffDirs(testpath1, testpath2, True, open(args.out, "w"), args.jobs,
+             funcdiff=args.funcdiff)
 
   def ll(self):
-    pass
+    parser = argparse.ArgumentParser(
+      description = """
+Diffs LLVM bitcode files from two directories.
+""")
+    parser.add_argument('dir1', help='directory 1')
+    parser.add_argument('dir2', help='directory 2')
+    parser.add_argument('--out', help='Output file path', required=True,
+                        action='store')
+    parser.add_argument('--jobs', help='# of processes to use', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--llvm-dis', help='llvm-dis for directory 1',
+                        action='store', default='llvm-dis')
+    parser.add_argument('--llvm-dis2', help='llvm-dis for directory 2 (default: --llvm-dis)',
+                        action='store')
+    args = parser.parse_args(sys.argv[2:])
+
+    llvmdis2 = args.llvm_dis2 if args.llvm_dis2 else args.llvm_dis
+    print(args.dir1)
+    print(args.dir2)
+    diffDirs(args.dir1, args.dir2, False, open(args.out, "w"), args.jobs,
+             args.llvm_dis, llvmdis2)
 
 if __name__ == '__main__':
   DiffUtil()
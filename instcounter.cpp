@@ -44,7 +44,7 @@ class InstCountPass : public FunctionPass, public InstVisitor<InstCountPass> {
   }
   void countIntrinsics(Instruction *I) {
     if (IntrinsicInst *II = dyn_cast<IntrinsicInst>(I)) {
-      NumIntrinsics[II->getCalledFunction()->getName()]++;
+      NumIntrinsics[II->getCalledFunction()->getName().str()]++;
     }
   }
   void visitConstExpr(User *U) {
@@ -89,23 +89,35 @@ static RegisterPass<InstCountPass> X("hello", "Hello World Pass",
                              false /* Only looks at CFG */,
                              false /* Analysis Pass */);
 
-void printMapAsJson(const std::map<std::string, int> &m, std::stringstream &ss) {
+void printMapAsJson(const std::map<std::string, int> &m, std::stringstream &ss,
+                    bool compact) {
   bool first = true;
   for (auto itr = m.begin(); itr != m.end(); itr++) {
     if (!first)
-      ss << ",\n";
-    ss << "\t\t\"" << itr->first << "\":" << itr->second;
+      ss << (compact ? "," : ",\n");
+    ss << (compact ? "\"" : "\t\t\"") << itr->first << "\":" << itr->second;
     first = false;
   }
 }
 
-int main(int argc, char *argv[]){
-  if (argc != 2 && argc != 3) {
-    errs() << "Usage : " << argv[0] << " <.bc file>" << "\n";
-    return 1;
+void printStringAsJson(StringRef str, std::stringstream &ss) {
+  ss << "\"";
+  for (char c : str) {
+    if (c == '"' || c == '\\')
+      ss << '\\' << c;
+    else if (c == '\n')
+      ss << "\\n";
+    else if (c == '\t')
+      ss << "\\t";
+    else
+      ss << c;
   }
+  ss << "\"";
+}
 
-  StringRef filename = argv[1];
+// Counts instructions of a module and prints the result as json.
+// If compact is true, the result is printed in one line with its path.
+int countModule(StringRef filename, std::stringstream &ss, bool compact) {
   LLVMContext context;
 
   ErrorOr<std::unique_ptr<MemoryBuffer>> fileOrErr = 
@@ -126,31 +138,86 @@ int main(int argc, char *argv[]){
   if (moduleExpct) {
     m = std::move(moduleExpct.get());
   } else {
+    consumeError(moduleExpct.takeError());
     errs() << "Error reading module\n";
     return 3;
   }
   
-  InstCountPass *ip = new InstCountPass();
+  std::unique_ptr<InstCountPass> ip(new InstCountPass());
   for (auto fitr = m->getFunctionList().begin(); 
       fitr != m->getFunctionList().end(); fitr++) {
     Function &f = *fitr;
     ip->runOnFunction(f);
   }
 
-  std::stringstream ss;
-  ss << "{\n";
-  ss << "\t\"total\":" << ip->TotalInsts << ",\n";
-  ss << "\t\"instrs\": {\n";
-  printMapAsJson(ip->NumInst, ss);
-  ss << "\n\t},\n";
-  ss << "\t\"intrinsics\": {\n";
-  printMapAsJson(ip->NumIntrinsics, ss);
-  ss << "\n\t},\n";
-  ss << "\t\"constexprs\": {\n";
-  printMapAsJson(ip->NumConstExpr, ss);
-  ss << "\n\t}\n";
+  const char *nl = compact ? "" : "\n";
+  const char *tab = compact ? "" : "\t";
+  ss << "{" << nl;
+  if (compact) {
+    ss << "\"path\":";
+    printStringAsJson(filename, ss);
+    ss << ",";
+  }
+  ss << tab << "\"total\":" << ip->TotalInsts << "," << nl;
+  ss << tab << "\"instrs\": {" << nl;
+  printMapAsJson(ip->NumInst, ss, compact);
+  ss << nl << tab << "}," << nl;
+  ss << tab << "\"intrinsics\": {" << nl;
+  printMapAsJson(ip->NumIntrinsics, ss, compact);
+  ss << nl << tab << "}," << nl;
+  ss << tab << "\"constexprs\": {" << nl;
+  printMapAsJson(ip->NumConstExpr, ss, compact);
+  ss << nl << tab << "}" << nl;
   ss << "}";
-
-  std::cout << ss.str();
   return 0;
 }
+
+// Prints the result of a module in one line. A module that cannot be read is
+// printed as {"path":..., "error":<code>}.
+int countModuleAsLine(StringRef filename) {
+  std::stringstream ss;
+  int res = countModule(filename, ss, true);
+  if (res != 0) {
+    ss.str("");
+    ss << "{\"path\":";
+    printStringAsJson(filename, ss);
+    ss << ",\"error\":" << res << "}";
+  }
+  std::cout << ss.str() << std::endl;
+  return res;
+}
+
+int main(int argc, char *argv[]){
+  if (argc < 2) {
+    errs() << "Usage : " << argv[0] << " <.bc file>\n"
+           << "        " << argv[0] << " <.bc file> <.bc file> ...\n"
+           << "        " << argv[0] << " --stdin  (reads .bc file paths from stdin)\n"
+           << "With multiple files, one json object is printed per line.\n";
+    return 1;
+  }
+
+  if (argc == 2 && std::string(argv[1]) != "--stdin") {
+    std::stringstream ss;
+    int res = countModule(argv[1], ss, false);
+    if (res != 0)
+      return res;
+    std::cout << ss.str();
+    return 0;
+  }
+
+  int res = 0;
+  if (std::string(argv[1]) == "--stdin") {
+    std::string line;
+    while (std::getline(std::cin, line)) {
+      if (line.empty())
+        continue;
+      if (countModuleAsLine(line) != 0)
+        res = 4;
+    }
+  } else {
+    for (int i = 1; i < argc; ++i)
+      if (countModuleAsLine(argv[i]) != 0)
+        res = 4;
+  }
+  return res;
+}
@@ -0,0 +1,95 @@
+import os
+import threading
+import time
+
+# Watches memory used by build jobs (processes under ninja), so that builds
+# can reduce their jobs before the machine runs out of memory.
+
+LINKERS = set(["ld", "ld.lld", "lld", "ld.gold", "ld.bfd", "collect2",
+               "ld64.lld", "lld-link", "mold"])
+
+# Returns (MemTotal, MemAvailable) in bytes.
+def readMemInfo():
+  info = dict()
+  for l in open("/proc/meminfo", "r"):
+    k, v = l.split(":", 1)
+    info[k] = int(v.split()[0]) * 1024
+  return (info["MemTotal"], info.get("MemAvailable", info["MemFree"]))
+
+# Returns a list of (pid, ppid, name, RSS in bytes) of all processes.
+def _listProcesses():
+  pagesize = os.sysconf("SC_PAGE_SIZE")
+  procs = []
+  for d in os.listdir("/proc"):
+    if not d.isdigit():
+      continue
+    try:
+      stat = open("/proc/%s/stat" % d, "r").read()
+      statm = open("/proc/%s/statm" % d, "r").read()
+    except OSError:
+      continue
+    # The name is in parentheses and may have spaces
+    name = stat[stat.find("(") + 1:stat.rfind(")")]
+    ppid = int(stat[stat.rfind(")") + 2:].split()[1])
+    procs.append((int(d), ppid, name, int(statm.split()[1]) * pagesize))
+  return procs
+
+# Returns (RSS of compile jobs, RSS of link jobs) of the jobs that process
+# pid (ninja) is running. A job is a child of pid with its descendants; it is
+# a link job if a linker is among them.
+def jobMemoryUsage(pid):
+  procs = _listProcesses()
+  children = dict()
+  for p in procs:
+    children.setdefault(p[1], []).append(p)
+
+  compile = []
+  link = []
+  for job in children.get(pid, []):
+    rss = 0
+    islink = False
+    worklist = [job]
+    while len(worklist) > 0:
+      p = worklist.pop()
+      rss = rss + p[3]
+      islink = islink or p[2] in LINKERS
+      worklist = worklist + children.get(p[0], [])
+    (link if islink else compile).append(rss)
+  return (compile, link)
+
+# Memory that builds running at the same time share.
+# A build that uses the most memory is asked to reduce its jobs when the
+# builds use more than the budget, or available memory is less than 5%.
+class MemoryBudget(object):
+  def __init__(self, budget=None, nbuilds=1):
+    total, avail = readMemInfo()
+    self.total = total
+    self.budget = budget if budget else int(total * 0.9)
+    self.nbuilds = nbuilds
+    self.lock = threading.Lock()
+    self.usage = dict()
+    self.lastreduce = 0.0
+
+  # Memory a build can use
+  def share(self):
+    return self.budget // self.nbuilds
+
+  # Updates the memory usage of build name. Returns True if the build should
+  # reduce its jobs.
+  def update(self, name, rss):
+    with self.lock:
+      self.usage[name] = rss
+      total, avail = readMemInfo()
+      if sum(self.usage.values()) <= self.budget and avail >= total * 0.05:
+        return False
+      # Wait until the last reduction takes effect
+      if time.time() - self.lastreduce < 15:
+        return False
+      if max(self.usage.keys(), key=lambda k: self.usage[k]) != name:
+        return False
+      self.lastreduce = time.time()
+      return True
+
+  def finish(self, name):
+    with self.lock:
+      self.usage.pop(name, None)
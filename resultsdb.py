@@ -0,0 +1,139 @@
+import datetime
+import json
+import os
+import re
+import socket
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY,
+  path TEXT,
+  name TEXT,
+  time TEXT,
+  machine TEXT,
+  llvmcommit TEXT,
+  config TEXT,
+  runcfg TEXT
+);
+CREATE TABLE IF NOT EXISTS tests (
+  id INTEGER PRIMARY KEY,
+  name TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS samples (
+  run INTEGER,
+  test INTEGER,
+  iteration INTEGER,
+  metric TEXT,
+  value REAL
+);
+CREATE INDEX IF NOT EXISTS samples_run ON samples (run, metric);
+CREATE INDEX IF NOT EXISTS samples_test ON samples (test, metric);
+CREATE INDEX IF NOT EXISTS runs_path ON runs (path);
+"""
+
+def openResultsDB(path):
+  db = sqlite3.connect(path)
+  db.executescript(SCHEMA)
+  return db
+
+# Returns the names of result files at path: resultsN.json of llvm-lit (or
+# filtered ones) in the order of N, and report.json of lnt. Other json files
+# (e.g. stamps of run.py) are not results.
+def listResultFiles(path):
+  files = []
+  for f in os.listdir(path):
+    m = re.match(r"^(results|report)([0-9]*).*\.json$", f)
+    if m:
+      files.append((int(m.group(2)) if m.group(2) else 0, f))
+  return [f for n, f in sorted(files)]
+
+# Reads samples from result files at path. The iteration is the index in
+# listResultFiles, e.g. 9 for results10.json.
+# Returns a list of (test name, iteration, metric, value).
+def _readSamples(path):
+  samples = []
+  files = listResultFiles(path)
+  for itr, fs in enumerate(files):
+    js = json.load(open(os.path.join(path, fs)))
+
+    if "tests" in js:
+      # test-suite was run with cmake
+      for t in js["tests"]:
+        for k, v in t["metrics"].items():
+          if isinstance(v, (int, float)) and not isinstance(v, bool):
+            samples.append((t["name"], itr, k, v))
+    elif "Tests" in js:
+      # test-suite was run with lnt script
+      for t in js["Tests"]:
+        n = t["Name"]
+        if not n.endswith(".exec"):
+          continue
+        assert len(t["Data"]) == 1
+        samples.append((n[:-len(".exec")], itr, "exec_time", t["Data"][0]))
+  return samples
+
+# Stores the results at path as a new run and returns its id.
+# A run that was ingested from the same path before is replaced.
+def ingestResults(db, path, name=None, cfg=None, runcfg=None, commit=None):
+  path = os.path.abspath(path)
+  samples = _readSamples(path)
+  cur = db.cursor()
+
+  for (runid,) in cur.execute("SELECT id FROM runs WHERE path = ?", (path,)).fetchall():
+    cur.execute("DELETE FROM samples WHERE run = ?", (runid,))
+    cur.execute("DELETE FROM runs WHERE id = ?", (runid,))
+
+  cur.execute("INSERT INTO runs (path, name, time, machine, llvmcommit, config, runcfg) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?)",
+              (path, name if name else os.path.basename(path),
+               datetime.datetime.now().isoformat(timespec="seconds"),
+               socket.gethostname(), commit,
+               json.dumps(cfg) if cfg else None,
+               json.dumps(runcfg) if runcfg else None))
+  runid = cur.lastrowid
+
+  testids = dict()
+  for n in set([s[0] for s in samples]):
+    cur.execute("INSERT OR IGNORE INTO tests (name) VALUES (?)", (n,))
+    testids[n] = cur.execute("SELECT id FROM tests WHERE name = ?", (n,)).fetchone()[0]
+
+  cur.executemany("INSERT INTO samples (run, test, iteration, metric, value) "
+                  "VALUES (?, ?, ?, ?, ?)",
+                  [(runid, testids[n], itr, k, v) for n, itr, k, v in samples])
+  db.commit()
+  return runid
+
+# Returns test name -> list of values, like readJsonResults at run.py.
+def readDBResults(db, runid, key):
+  res = dict()
+  rows = db.execute("SELECT tests.name, samples.value FROM samples "
+                    "JOIN tests ON tests.id = samples.test "
+                    "WHERE samples.run = ? AND samples.metric = ? "
+                    "ORDER BY samples.iteration", (runid, key))
+  for n, v in rows:
+    res.setdefault(n, []).append(v)
+  return res
+
+# Returns a list of (id, name, time, machine, commit, path) of runs.
+def listRuns(db):
+  return db.execute("SELECT id, name, time, machine, llvmcommit, path FROM runs "
+                    "ORDER BY id").fetchall()
+
+# Returns a list of (run id, run name, time, commit, test name, values) of
+# tests whose names contain pattern.
+def testHistory(db, pattern, key):
+  rows = db.execute("SELECT runs.id, runs.name, runs.time, runs.llvmcommit, "
+                    "tests.name, samples.value FROM samples "
+                    "JOIN tests ON tests.id = samples.test "
+                    "JOIN runs ON runs.id = samples.run "
+                    "WHERE tests.name LIKE ? AND samples.metric = ? "
+                    "ORDER BY tests.name, runs.id, samples.iteration",
+                    ("%" + pattern + "%", key))
+  res = []
+  for runid, runname, time, commit, testname, v in rows:
+    if len(res) > 0 and res[-1][0] == runid and res[-1][4] == testname:
+      res[-1][5].append(v)
+    else:
+      res.append((runid, runname, time, commit, testname, [v]))
+  return res
@@ -1,23 +1,35 @@
 #!/usr/bin/python3
 import argparse
+import bisect
 import csv
 import datetime
+import fcntl
 import glob
+import hashlib
 import json
 import multiprocessing
+import multiprocessing.pool
 import os
 import random
 import re
 import shutil
+import signal
 import smtplib
 import socket
 import stat
 import string
 import subprocess
 import sys
+import threading
+import time
 import uuid
-from subprocess import Popen
 from diffutil import *
+from statutil import *
+from resultsdb import *
+from tracing import *
+from buildlog import *
+from memwatch import *
+from buildcache import *
 
 
 errmsg = lambda attrname, filename: "Attribute %s does not exist%s" % \
@@ -58,6 +70,7 @@ def newParser(cmd, desc=None, llvm=False, llvm2=False, testsuite=False, run=Fals
   if desc == None:
     desc = 'Arguments for %s command' % cmd
   parser = argparse.ArgumentParser(description = desc)
+  addTraceArgument(parser)
 
   multi_cfg = False
   if len(list(filter((lambda x: x), [llvm, testsuite, run, spec]))) > 1:
@@ -120,6 +133,63 @@ def startGitClone(repo, dest, branch, depth):
   assert(p != None)
   return p
 
+# Returns the path of the bare mirror of the LLVM config, or None.
+# "mirror" is the path of the mirror, or true to use a mirror at the cache.
+def getGitMirrorPath(cfg):
+  if "mirror" not in cfg or cfg["mirror"] == False:
+    return None
+  if cfg["mirror"] == True:
+    h = hashlib.sha1(cfg["repo"].encode("utf-8")).hexdigest()
+    return os.path.join(getCacheDir("git"), "%s.git" % h[:16])
+  return os.path.abspath(os.path.expanduser(cfg["mirror"]))
+
+# Creates or updates the bare mirror of repo. Branches of repo are fetched to
+# refs/remotes/origin/* so that they do not clash with branches of worktrees.
+# If filter is given (e.g. blob:none), the mirror is a partial clone.
+# Returns True if successful.
+def updateGitMirror(repo, mirror, filter=None):
+  os.makedirs(os.path.dirname(mirror), exist_ok=True)
+  # Configs that share the mirror may be cloned at the same time
+  with open(mirror + ".lock", "w") as lockf:
+    fcntl.flock(lockf, fcntl.LOCK_EX)
+    if not os.path.exists(mirror):
+      cmds = ["git", "clone", "--bare", repo, mirror]
+      if filter:
+        cmds.append("--filter=%s" % filter)
+      if Popen(cmds).wait() != 0:
+        return False
+      Popen(["git", "config", "remote.origin.fetch",
+             "+refs/heads/*:refs/remotes/origin/*"], cwd=mirror).wait()
+    print("Fetching %s to %s" % (repo, mirror))
+    return Popen(["git", "fetch", "--prune", "origin"], cwd=mirror).wait() == 0
+
+# Checks out branch of the mirror to dest.
+# mode is "worktree" (a worktree of the mirror) or "reference" (a clone that
+# borrows objects from the mirror). filter is the filter of the mirror.
+def startGitCheckoutFromMirror(repo, mirror, dest, branch, mode, filter=None):
+  print("repo: " + repo)
+  print("mirror: " + mirror)
+  print("dest: " + dest)
+  if os.path.exists(dest):
+    print ("Directory '{0}' already exists.. continuing".format(dest))
+    return None
+
+  if mode == "reference":
+    cmds = ["git", "clone", "--reference", mirror, repo, dest]
+    if filter:
+      # A partial mirror lacks blobs that were never checked out, and repo
+      # does not send them unless dest is a partial clone as well
+      cmds.append("--filter=%s" % filter)
+    if branch != None:
+      cmds = cmds + ["--branch", branch]
+    return Popen(cmds)
+
+  assert(mode == "worktree"), "Unknown clone-mode: %s" % mode
+  assert(branch != None), "branch is needed to create a worktree"
+  # Fails if another worktree has the branch checked out
+  return Popen(["git", "worktree", "add", "-B", branch, dest,
+                "origin/%s" % branch], cwd=mirror)
+
 # Send a mail.
 def sendMail(mailcfg, title, contents):
   efrom = mailcfg["from"]
@@ -147,6 +217,99 @@ Subject: %s
   except Exception as e:
     print(e)
 
+# Returns the commit hash of the git repo at src, or None if unknown.
+def getGitCommit(src):
+  try:
+    p = Popen(["git", "rev-parse", "HEAD"], cwd=src, stdout=subprocess.PIPE,
+              stderr=subprocess.DEVNULL)
+  except OSError:
+    return None
+  out, err = p.communicate()
+  return out.decode("utf-8").strip() if p.returncode == 0 else None
+
+# Returns True if the git repo at src has changes that are not committed
+def hasGitChanges(src):
+  p = Popen(["git", "status", "--porcelain", "--untracked-files=no"], cwd=src,
+            stdout=subprocess.PIPE)
+  out, err = p.communicate()
+  return p.returncode != 0 or out.strip() != b""
+
+# Identifies host compilers (e.g. ["gcc", "g++"]) by their paths and versions
+def getCompilerId(compilers):
+  ids = []
+  for c in compilers:
+    path = shutil.which(c)
+    if path == None:
+      ids.append(c)
+      continue
+    p = Popen([path, "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    out, err = p.communicate()
+    ids.append("%s: %s" % (os.path.realpath(path),
+                           out.decode("utf-8").split("\n")[0].strip()))
+  return ids
+
+# Returns the directory for caching files of llvmscript (~/.cache/llvmscript/<name>)
+def getCacheDir(name):
+  base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+  d = os.path.join(base, "llvmscript", name)
+  os.makedirs(d, exist_ok=True)
+  return d
+
+def fileHash(path):
+  h = hashlib.sha1()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+# Removes least recently used entries of the compile cache at cachedir (see
+# cc.sh) until it gets smaller than 90% of maxsize (bytes), if it is larger
+# than maxsize. An entry is <key>.o with its side output (<key>.s or .bc),
+# and a cache hit updates the modification time of <key>.o .
+def evictCompileCache(cachedir, maxsize):
+  with open(os.path.join(cachedir, ".lock"), "w") as lockf:
+    fcntl.flock(lockf, fcntl.LOCK_EX)
+    entries = dict()
+    total = 0
+    for dp, dn, filenames in os.walk(cachedir):
+      for f in filenames:
+        base, ext = os.path.splitext(os.path.join(dp, f))
+        if ext not in [".o", ".s", ".bc"]:
+          continue
+        try:
+          st = os.stat(base + ext)
+        except OSError:
+          continue
+        e = entries.setdefault(base, [0.0, 0])
+        e[1] = e[1] + st.st_size
+        if ext == ".o":
+          e[0] = st.st_mtime
+        total = total + st.st_size
+    if total <= maxsize:
+      return
+
+    removed = 0
+    for base, (mtime, size) in sorted(entries.items(), key=lambda e: e[1][0]):
+      if total <= maxsize * 0.9:
+        break
+      for ext in [".o", ".s", ".bc"]:
+        if os.path.exists(base + ext):
+          os.remove(base + ext)
+      total = total - size
+      removed = removed + 1
+    print("Removed %d entries from the compile cache at %s" % (removed, cachedir))
+
+# MAKEFLAGS for make to take job slots from the jobserver at fds (a pair of
+# pipe fds). GNU make before 4.2 only knows --jobserver-fds, and later ones
+# use --jobserver-auth.
+def makeJobserverFlags(fds):
+  p = Popen(["make", "--version"], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+  out, err = p.communicate()
+  m = re.match(r"GNU Make ([0-9]+)\.([0-9]+)", out.decode("utf-8"))
+  old = m != None and (int(m.group(1)), int(m.group(2))) < (4, 2)
+  return "-j --jobserver-%s=%d,%d" % ("fds" if old else "auth", fds[0], fds[1])
+
 def runAsSudo(cmd):
   if isinstance(cmd, str):
     p = Popen(["sudo", "-S", "sh", "-c", cmd])
@@ -172,6 +335,61 @@ def setScalingGovernor():
     f = p + "scaling_governor"
     runAsSudo("echo performance > %s" % f)
 
+# "0-3,8" -> [0, 1, 2, 3, 8]
+def parseCPUList(s):
+  cpus = []
+  for r in s.strip().split(","):
+    if r == "":
+      continue
+    if "-" in r:
+      lo, hi = r.split("-")
+      cpus = cpus + list(range(int(lo), int(hi) + 1))
+    else:
+      cpus.append(int(r))
+  return cpus
+
+def _readSysFile(path, default=""):
+  try:
+    return open(path, "r").read()
+  except OSError:
+    return default
+
+# CPUs to run benchmarks on: one logical CPU per physical core, so that SMT
+# siblings are left idle. Isolated CPUs are used if there are any; otherwise
+# all online CPUs but the core of CPU 0. CPUs are interleaved over NUMA nodes.
+def getBenchmarkCPUs(count=None):
+  sysdir = "/sys/devices/system/cpu"
+  siblings = lambda c: parseCPUList(_readSysFile(
+      "%s/cpu%d/topology/thread_siblings_list" % (sysdir, c), str(c)))
+
+  cpus = parseCPUList(_readSysFile(sysdir + "/isolated"))
+  if len(cpus) == 0:
+    online = parseCPUList(_readSysFile(sysdir + "/online", "0"))
+    cpus = [c for c in online if c not in siblings(0)]
+    if len(cpus) == 0:
+      cpus = online
+
+  picked = []
+  used = set()
+  for c in sorted(cpus):
+    if c in used:
+      continue
+    used.update(siblings(c))
+    picked.append(c)
+
+  nodeof = dict()
+  for d in glob.glob("/sys/devices/system/node/node[0-9]*"):
+    for c in parseCPUList(_readSysFile(d + "/cpulist")):
+      nodeof[c] = int(os.path.basename(d)[len("node"):])
+  bynode = dict()
+  for c in picked:
+    bynode.setdefault(nodeof.get(c, 0), []).append(c)
+  lists = [bynode[n] for n in sorted(bynode.keys())]
+  spread = []
+  for i in range(0, max([len(l) for l in lists])):
+    spread = spread + [l[i] for l in lists if i < len(l)]
+  return spread[:count] if count else spread
+
 def checkPerf():
   p = Popen(["perf", "stat", "echo", "hi"])
   p.wait()
@@ -181,11 +399,54 @@ def checkPerf():
 
 
 
-def readJsonResults(path, key):
+# The name of a perf event without the PMU and modifiers; this is the name
+# of its metric at results (e.g. "cpu_core/cycles/u" -> "cycles")
+def perfEventName(event):
+  if "/" in event:
+    parts = [x for x in event.split("/") if x]
+    event = parts[1] if len(parts) > 1 else parts[0]
+  return event.split(":")[0]
+
+# Returns the events that `perf stat` can count at this machine among events.
+def getSupportedPerfEvents(events):
+  supported = []
+  for e in events:
+    try:
+      p = Popen(["perf", "stat", "-x", ",", "-e", e, "true"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError:
+      print("Warning: perf is not found; perf-events are not collected")
+      return []
+    out, err = p.communicate()
+    counted = [l for l in err.decode("utf-8").split("\n")
+               if len(l.split(",")) > 2 and not l.startswith("#") and
+                  not l.startswith("<")]
+    if p.returncode == 0 and len(counted) > 0:
+      supported.append(e)
+    else:
+      print("Warning: perf cannot count %s at this machine" % e)
+  return supported
+
+# Reads the output of `perf stat -x,`. Returns event name -> count.
+def readPerfStat(path):
   res = dict()
-  for fs in os.listdir(path):
-    if not fs.endswith(".json"):
+  for l in open(path, "r"):
+    fields = l.strip().split(",")
+    if l.startswith("#") or len(fields) < 3:
       continue
+    try:
+      v = float(fields[0])
+    except ValueError:
+      # <not counted> or <not supported>
+      continue
+    n = perfEventName(fields[2])
+    res[n] = res.get(n, 0.0) + v
+  return res
+
+
+def readJsonResults(path, key):
+  res = dict()
+  for fs in listResultFiles(path):
     js = json.load(open(os.path.join(path, fs)))
 
     if "tests" in js:
@@ -226,6 +487,24 @@ def readRunningTimes(path):
 def readObjSizes(path):
   return readJsonResults(path, "size")
 
+# Reads results of test-suite that were run in pairs, e.g. by `run.py abtest`.
+# resultN.json at path1 and path2 are paired.
+# Returns test name -> list of (value at path1, value at path2).
+def readPairedResults(path1, path2, key):
+  res = dict()
+  files = set(listResultFiles(path2))
+  for fs in [f for f in listResultFiles(path1) if f in files]:
+    vals = [dict(), dict()]
+    for i, path in enumerate([path1, path2]):
+      js = json.load(open(os.path.join(path, fs)))
+      for t in js["tests"]:
+        if key in t["metrics"]:
+          vals[i][t["name"]] = t["metrics"][key]
+    for n in vals[0]:
+      if n in vals[1]:
+        res.setdefault(n, []).append((vals[0][n], vals[1][n]))
+  return res
+
 
 # Main object.
 class LLVMScript(object):
@@ -237,19 +516,25 @@ class LLVMScript(object):
 Commands:
   clone     Clone LLVM
   build     Build LLVM
+  buildreport Show where the time was spent building LLVM
   initlnt   Clone & initialize test-suite and lnt
   test      Run LIT tests
   testsuite Run test-suite using cmake
   lnt       Run test-suite using lnt
   spec      Run SPEC benchmark
   diff      Compile test-suite with different clangs and compare assembly files
+  abtest    Run test-suite with two clangs in interleaved order
+  bisect    Find the LLVM commit that made benchmarks slower
   compare   Compare performance results of test-suite
+  ingest    Store performance results of test-suite to a database
+  history   Show performance results stored at a database
   instcount Get statistics of the number of LLVM assembly instructions
   filter    Filter test-suite result with assembly diff
   check     Check wellformedness of config files
   mailtest  Test the mail account
 
 Type 'python3 run.py <command> help' to get details
+Add '--trace out.json' to any command to record where time is spent
 ''')
 
     parser.add_argument('command', help='')
@@ -279,6 +564,18 @@ Type 'python3 run.py <command> help' to get details
 
     abssrc = os.path.abspath(cfg["src"])
 
+    # Checkouts of the configs that have the same mirror share git objects
+    mirror = getGitMirrorPath(cfg)
+    mode = cfg["clone-mode"] if "clone-mode" in cfg else "worktree"
+    if mirror:
+      if args.depth:
+        print("Warning: --depth is ignored because mirror is set; "
+              "use \"filter\": \"blob:none\" to download less")
+      if not updateGitMirror(cfg["repo"], mirror,
+                             cfg["filter"] if "filter" in cfg else None):
+        print("Cannot update the mirror at %s" % mirror)
+        exit(1)
+
     def _callGitClone (cfg):
       repo = cfg["repo"]
       branch = cfg["branch"]
@@ -312,15 +609,23 @@ Type 'python3 run.py <command> help' to get details
           exit(1)
 
         # Fetch the branch
-        Popen(["git", "fetch", "origin"], cwd=dest,
-              stdout=subprocess.PIPE, stderr=subprocess.PIPE).wait()
+        if mirror and mode == "worktree":
+          # Worktrees share refs of the mirror, which is fetched already
+          pass
+        else:
+          Popen(["git", "fetch", "origin"], cwd=dest,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE).wait()
         return Popen(["git", "reset", "--hard", "origin/%s" % branch], cwd=dest)
 
+      if mirror:
+        return startGitCheckoutFromMirror(repo, mirror, dest, branch, mode,
+                                          cfg["filter"] if "filter" in cfg else None)
       return startGitClone(repo, dest, branch, depth)
 
     p = _callGitClone(cfg)
-    if p:
-      p.wait()
+    if p and p.wait() != 0:
+      print("Cannot check out %s at %s" % (cfg["branch"], abssrc))
+      exit(1)
 
     if args.mailcfg:
       cfg = json.load(open(args.mailcfg, "r"))
@@ -334,41 +639,83 @@ Type 'python3 run.py <command> help' to get details
   def build(self):
     parser = newParser("build", desc="Builds LLVM from a cloned repo",
                        llvm=True, sendmail=True, optionals=["sendmail"])
-    parser.add_argument('--type', help='release/relassert/debug', action='store', required=True)
+    parser.add_argument('--type', help='release/relassert/debug; several '
+                        'types separated by comma are built at the same time',
+                        action='store', required=True)
     parser.add_argument('--core', help='# of cores to use', nargs='?', const=1, type=int)
     parser.add_argument('--target', help='targets, separated by comma (ex: opt,clang,llvm-as)',
                         action='store')
     parser.add_argument('--dry', help='Dry-run', action='store_true')
+    parser.add_argument('--memory-aware', action='store_true',
+        help='Reduce build jobs and link jobs when memory gets low')
+    parser.add_argument('--mem-budget', action='store', type=float,
+        help='Memory (GB) that builds can use (implies --memory-aware; '
+             'default: 90%% of the memory)')
     args = parser.parse_args(sys.argv[2:])
 
     cfgpath = args.cfg
     f = open(cfgpath)
     cfg = json.load(f)
 
-    if args.type != "release" and args.type != "relassert" and args.type != "debug":
-      print ("Unknown build option: {}; should be release / relassert / debug.".format(args.type))
-      exit(1)
+    types = args.type.split(",")
+    for t in types:
+      if t != "release" and t != "relassert" and t != "debug":
+        print ("Unknown build option: {}; should be release / relassert / debug.".format(t))
+        exit(1)
+      checkLLVMConfigForBuild(cfg, t)
 
-    checkLLVMConfigForBuild(cfg, args.type)
+    if args.dry:
+      # Dry-run
+      for t in types:
+        cmd = self._getLLVMCMakeCommand(cfg, t)
+        print(cmd[0] + " " + cmd[1] + " \\")
+        for i in range(2, len(cmd)):
+          s = "\t" + cmd[i]
+          if i < len(cmd) - 1:
+            s = s + " \\"
+          print(s)
+      return
 
-    options = cfg["builds"][args.type]
-    prevpath = os.getcwd()
+    buildarg = args.target.split(',') if args.target else []
+    corecnt = args.core if args.core else multiprocessing.cpu_count()
 
-    abspath = os.path.abspath(options["path"])
-    if not os.path.exists(abspath):
-      try:
-        os.makedirs(abspath)
-      except OSError as e:
-        print ("Cannot create directory '{0}'.".format(options["path"]))
-        exit(1)
+    membudget = None
+    if args.memory_aware or args.mem_budget:
+      membudget = MemoryBudget(int(args.mem_budget * (1 << 30)) if args.mem_budget
+                               else None, len(types))
 
+    def _build(t, jobs):
+      if self._buildLLVM(cfg, t, buildarg, jobs, membudget) == 0 and \
+         cfg.get("build-cache") not in (None, False):
+        self._storeBuiltToolchain(cfg, t, buildarg)
+
+    if len(types) == 1:
+      _build(types[0], corecnt)
+    else:
+      # The builds share the cores
+      threads = [threading.Thread(target=_build,
+                                  args=(t, max(1, corecnt // len(types))))
+                 for t in types]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+
+    if args.mailcfg:
+      cfg = json.load(open(args.mailcfg, "r"))
+      sendMail(cfg, "build", str(args))
+
+  # Returns the cmake command for building LLVM.
+  # If linkjobs is given, it overrides parallel-link-jobs.
+  def _getLLVMCMakeCommand(self, cfg, buildtype, linkjobs=None):
+    options = cfg["builds"][buildtype]
     cmd = ["cmake", "-GNinja", os.path.join(os.path.abspath(cfg["src"]), "llvm")]
 
-    if args.type == "release":
+    if buildtype == "release":
       cmd.append("-DCMAKE_BUILD_TYPE=Release")
-    elif args.type == "relassert":
+    elif buildtype == "relassert":
       cmd = cmd + ["-DCMAKE_BUILD_TYPE=Release", "-DLLVM_ENABLE_ASSERTIONS=On"]
-    elif args.type == "debug":
+    elif buildtype == "debug":
       cmd.append("-DCMAKE_BUILD_TYPE=Debug")
 
     if hasAndEquals(options, "sharedlib", True):
@@ -408,11 +755,12 @@ Type 'python3 run.py <command> help' to get details
     else:
       cmd.append("-DLLVM_ENABLE_Z3_SOLVER=OFF")
 
-    if "parallel-link-jobs" in options:
-      jobs = str(options["parallel-link-jobs"])
-      cmd.append("-DLLVM_PARALLEL_LINK_JOBS=" + jobs)
+    if linkjobs == None and "parallel-link-jobs" in options:
+      linkjobs = options["parallel-link-jobs"]
+    if linkjobs != None:
+      cmd.append("-DLLVM_PARALLEL_LINK_JOBS=" + str(linkjobs))
 
-    projs = cfg["builds"][args.type]["projects"].split(";")
+    projs = options["projects"].split(";")
     if hasAndEquals(options, "use-lld", True):
       assert("lld" in projs), "lld should be listed at projects"
       cmd.append("-DCLANG_DEFAULT_LINKER=lld")
@@ -421,46 +769,346 @@ Type 'python3 run.py <command> help' to get details
     if "clang-tools-extra" in projs:
       cmd.append("-DLLVM_TOOL_CLANG_TOOLS_EXTRA_BUILD=On")
       #cmd.append("-DCLANGD_BUILD_XPC=Off") # clangd 8.0 does not compile
+    return cmd
 
-    if args.dry:
-      # Dry-run
-      print(cmd[0] + " " + cmd[1] + " \\")
-      for i in range(2, len(cmd)):
-        s = "\t" + cmd[i]
-        if i < len(cmd) - 1:
-          s = s + " \\"
-        print(s)
-      return
+  # Runs cmake and ninja to build LLVM of buildtype. Returns the exit code of
+  # ninja.
+  # If membudget is given, jobs are reduced when memory gets low.
+  def _buildLLVM(self, cfg, buildtype, targets, jobs, membudget=None):
+    options = cfg["builds"][buildtype]
+    abspath = os.path.abspath(options["path"])
+    if not os.path.exists(abspath):
+      try:
+        os.makedirs(abspath)
+      except OSError as e:
+        print ("Cannot create directory '{0}'.".format(options["path"]))
+        exit(1)
 
-    os.chdir(abspath)
-    p = Popen(cmd)
+    linkjobs = None
+    if membudget:
+      peaks = self._loadBuildMemPeaks(abspath)
+      if peaks["link"] > 0:
+        # Start with as many link jobs as the memory allows
+        linkjobs = max(1, min(jobs, membudget.share() // peaks["link"]))
+        if "parallel-link-jobs" in options:
+          linkjobs = min(linkjobs, options["parallel-link-jobs"])
+
+    cmakecmd = self._getLLVMCMakeCommand(cfg, buildtype, linkjobs)
+    p = Popen(cmakecmd, cwd=abspath)
     p.wait()
 
-    # Now build
-    buildarg = []
-    corecnt = multiprocessing.cpu_count()
+    logpos = ninjaLogPosition(abspath)
+    if membudget:
+      if linkjobs == None and "parallel-link-jobs" in options:
+        linkjobs = options["parallel-link-jobs"]
+      returncode = self._runNinjaWithMemoryBudget(cfg, buildtype, abspath, jobs,
+                                                  linkjobs, targets, membudget)
+    else:
+      p = Popen(["ninja", "-j%d" % jobs] + targets, cwd=abspath)
+      p.wait()
+      returncode = p.returncode
+    self._saveBuildLog(abspath, os.path.abspath(cfg["src"]), buildtype, cmakecmd,
+                       targets, jobs, returncode, logpos)
 
-    if args.target:
-      buildarg = args.target.split(',')
+    if "install-prefix" in options:
+      cmdargs = ["ninja", "install"]
+      p = Popen(cmdargs, cwd=abspath)
+      p.wait()
+    return returncode
+
+  # Returns the store of toolchains that build-cache at cfg specifies.
+  # build-cache is true or {"dir": <path>, "max-size-gb": <size>}; the default
+  # store is used if it is not given.
+  def _getToolchainStore(self, cfg):
+    cachecfg = cfg["build-cache"] if "build-cache" in cfg else True
+    if cachecfg == False:
+      print("build-cache is disabled at the LLVM config")
+      exit(1)
+    if not isinstance(cachecfg, dict):
+      cachecfg = dict()
+    cachedir = os.path.abspath(os.path.expanduser(cachecfg["dir"])) \
+               if "dir" in cachecfg else getCacheDir("toolchains")
+    maxsize = cachecfg["max-size-gb"] if "max-size-gb" in cachecfg else 50
+    return ToolchainStore(cachedir, int(maxsize * (1 << 30)))
+
+  # Key of the toolchain of commit that is built with cfg and buildtype.
+  # The source directory, link jobs and the install prefix do not change the
+  # toolchain.
+  def _getToolchainKey(self, cfg, buildtype, commit):
+    cmd = self._getLLVMCMakeCommand(cfg, buildtype)
+    cmakeargs = [a for a in cmd[3:]
+                 if not a.startswith("-DLLVM_PARALLEL_LINK_JOBS=") and
+                    not a.startswith("-DCMAKE_INSTALL_PREFIX=")]
+    options = cfg["builds"][buildtype]
+    compilerid = getCompilerId([options["cc"] if "cc" in options else "cc",
+                                options["cxx"] if "cxx" in options else "c++"])
+    return toolchainKey(commit, cmakeargs, compilerid)
+
+  # Copies the toolchain that `run.py build` built to the store, if clang was
+  # built from a commit without local changes
+  def _storeBuiltToolchain(self, cfg, buildtype, targets):
+    src = os.path.abspath(cfg["src"])
+    if len(targets) > 0 and "clang" not in targets:
+      return
+    commit = getGitCommit(src)
+    if commit == None or hasGitChanges(src):
+      print("Not storing the toolchain to build-cache: %s has local changes" % src)
+      return
+    store = self._getToolchainStore(cfg)
+    key = self._getToolchainKey(cfg, buildtype, commit)
+    builddir = os.path.abspath(cfg["builds"][buildtype]["path"])
+    path = store.add(key, builddir, {"commit": commit, "type": buildtype,
+                                     "cmake": self._getLLVMCMakeCommand(cfg, buildtype)})
+    print("Stored the toolchain of %s at %s" % (commit[:12], path))
+
+  # Returns the directory of the toolchain of commit from the store, building
+  # it if it is not stored. Returns None if it cannot be built.
+  # LLVM is built at <src>-buildcache (a worktree of src) and
+  # <path>-buildcache. If dev is True, the toolchain has llvm-config, headers
+  # and libraries as well.
+  def _getCachedToolchain(self, cfg, buildtype, commit, core, dev=False):
+    store = self._getToolchainStore(cfg)
+    key = self._getToolchainKey(cfg, buildtype, commit)
+    toolchain = store.lookup(key, dev)
+    if toolchain:
+      print("Using the toolchain of %s at %s" % (commit[:12], toolchain))
+      return toolchain
+
+    src = os.path.abspath(cfg["src"])
+    worktree = src + "-buildcache"
+    options = dict(cfg["builds"][buildtype])
+    options["path"] = os.path.abspath(options["path"]) + "-buildcache"
+    options.pop("install-prefix", None)
+    os.makedirs(options["path"], exist_ok=True)
+
+    # Other processes may be using the worktree
+    with open(options["path"] + ".lock", "w") as lockf:
+      fcntl.flock(lockf, fcntl.LOCK_EX)
+      toolchain = store.lookup(key, dev)
+      if toolchain:
+        return toolchain
+
+      if not os.path.exists(worktree):
+        Popen(["git", "worktree", "add", "--detach", worktree, commit], cwd=src).wait()
+      elif Popen(["git", "checkout", "--detach", "--force", commit],
+                 cwd=worktree).wait() != 0:
+        return None
+
+      cfg2 = dict(cfg)
+      cfg2["src"] = worktree
+      cfg2["builds"] = {buildtype: options}
+      targets = ["clang", "llvm-size", "llvm-dis"]
+      if hasAndEquals(options, "use-lld", True):
+        targets.append("lld")
+      if dev:
+        targets = targets + ["llvm-config", "llvm-libraries"]
+      if self._buildLLVM(cfg2, buildtype, targets,
+                         core if core else multiprocessing.cpu_count()) != 0:
+        return None
+      return store.add(key, options["path"],
+                       {"commit": commit, "type": buildtype,
+                        "cmake": self._getLLVMCMakeCommand(cfg2, buildtype)},
+                       worktree if dev else None)
+
+  # Returns a copy of cfg that uses the toolchain of rev (a commit, branch,
+  # ...) at src as the build of buildtype, with the commit at "commit".
+  # Exits if it cannot be built.
+  def _getCommitConfig(self, cfg, buildtype, rev, core=None, dev=False):
+    src = os.path.abspath(cfg["src"])
+    p = Popen(["git", "rev-parse", "--verify", rev + "^{commit}"], cwd=src,
+              stdout=subprocess.PIPE)
+    commit = p.communicate()[0].decode("utf-8").strip()
+    if p.returncode != 0 or commit == "":
+      print("Unknown commit: %s" % rev)
+      exit(1)
 
-    if args.core:
-      corecnt = args.core
+    toolchain = self._getCachedToolchain(cfg, buildtype, commit, core, dev)
+    if toolchain == None:
+      print("Cannot build LLVM at %s" % commit)
+      exit(1)
+    cfg2 = dict(cfg)
+    cfg2["name"] = "%s-%s" % (cfg["name"] if "name" in cfg else cfg["branch"],
+                              commit[:12])
+    cfg2["commit"] = commit
+    cfg2["builds"] = dict(cfg["builds"])
+    cfg2["builds"][buildtype] = dict(cfg["builds"][buildtype])
+    cfg2["builds"][buildtype]["path"] = toolchain
+    return cfg2
+
+  # Peak memory (bytes) of a compile job and a link job that were seen while
+  # building LLVM at builddir
+  def _loadBuildMemPeaks(self, builddir):
+    path = os.path.join(builddir, ".llvmscript-buildmem.json")
+    if os.path.exists(path):
+      return json.load(open(path, "r"))
+    return {"compile": 0, "link": 0}
+
+  # Runs ninja while watching memory used by its jobs. When membudget asks
+  # to reduce memory, ninja is interrupted and restarted with fewer link jobs
+  # (if links are running; cmake is re-run to change the link pool) or fewer
+  # jobs, estimated from the peak memory of jobs. Returns the exit code.
+  def _runNinjaWithMemoryBudget(self, cfg, buildtype, builddir, jobs, linkjobs,
+                                targets, membudget):
+    peaks = self._loadBuildMemPeaks(builddir)
+    # Peaks of the previous builds are used until jobs of this build are seen
+    seen = {"compile": 0, "link": 0}
+    returncode = None
+    while returncode == None:
+      print("Running ninja -j%d%s at %s" % (jobs, "" if linkjobs == None else
+            " (%d link jobs)" % linkjobs, builddir))
+      p = Popen(["ninja", "-j%d" % jobs] + targets, cwd=builddir)
+      while True:
+        try:
+          returncode = p.wait(timeout=1)
+          break
+        except subprocess.TimeoutExpired:
+          pass
+        compile, link = jobMemoryUsage(p.pid)
+        seen["compile"] = max([seen["compile"]] + compile)
+        seen["link"] = max([seen["link"]] + link)
+        if not membudget.update(buildtype, sum(compile) + sum(link)):
+          continue
 
-    cmd = ["ninja", "-j%d" % corecnt] + buildarg
+        share = membudget.share()
+        pc = max(seen["compile"], peaks["compile"], 1 << 28)
+        pl = max(seen["link"], peaks["link"], pc)
+        newjobs = jobs
+        newlinkjobs = linkjobs
+        if len(link) > 1:
+          newlinkjobs = max(1, min(len(link) - 1, share // pl))
+        elif jobs > 1:
+          newjobs = max(1, min(jobs - 1, share // pc))
+        if newjobs == jobs and newlinkjobs == linkjobs:
+          print("Warning: memory is low, but jobs of %s cannot be reduced" %
+                builddir)
+          continue
 
-    p = Popen(cmd)
-    p.wait()
+        print("Memory is low; restarting ninja at %s with -j%d%s" %
+              (builddir, newjobs, "" if newlinkjobs == None else
+               " and %d link jobs" % newlinkjobs))
+        p.send_signal(signal.SIGINT)
+        p.wait()
+        if newlinkjobs != linkjobs:
+          Popen(self._getLLVMCMakeCommand(cfg, buildtype, newlinkjobs),
+                cwd=builddir).wait()
+        jobs = newjobs
+        linkjobs = newlinkjobs
+        break
 
-    if "install-prefix" in options:
-      cmdargs = ["ninja", "install"]
-      p = Popen(cmdargs)
-      p.wait()
+    membudget.finish(buildtype)
+    for k in ["compile", "link"]:
+      if seen[k] > 0:
+        peaks[k] = seen[k]
+    json.dump(peaks, open(os.path.join(builddir, ".llvmscript-buildmem.json"), "w"))
+    return returncode
+
+  # Stores durations of targets that were built, from .ninja_log.
+  # logpos is the position of .ninja_log before building.
+  def _saveBuildLog(self, builddir, src, buildtype, cmakecmd, targets, jobs,
+                    returncode, logpos):
+    edges = readNinjaLog(builddir, logpos)
+    if len(edges) == 0:
+      return
+    summary = summarizeBuild(edges)
+    info = {"type": buildtype, "cmake": cmakecmd, "targets": targets,
+            "jobs": jobs, "returncode": returncode,
+            "commit": getGitCommit(src)}
+    path = saveBuildLog(builddir, summary, info)
+    print("Built %d targets in %.1f sec. (CPU %.1f sec., parallelism %.1f/%d);"
+          " see `run.py buildreport` (%s)" %
+          (len(edges), summary["wall"], summary["cpu"], summary["parallelism"],
+           jobs, path))
 
-    if args.mailcfg:
-      os.chdir(prevpath)
-      cfg = json.load(open(args.mailcfg, "r"))
-      sendMail(cfg, "build", str(args))
+  ############################################################
+  #            Report time spent building LLVM
+  ############################################################
+  def buildreport(self):
+    parser = newParser("buildreport", desc="""
+Shows where the time was spent building LLVM, from build logs that
+`run.py build` recorded from .ninja_log.
+The build is compared with the previous build that used the same cmake
+options (or --against).
+""", llvm=True)
+    parser.add_argument('--type', help='release/relassert/debug', action='store',
+                        required=True)
+    parser.add_argument('--log', action='store',
+        help='Build log to show (default: the latest one)')
+    parser.add_argument('--against', action='store',
+        help='Build log to compare with')
+    parser.add_argument('--top', action='store', type=int, default=20,
+        help='# of targets to show (default: 20)')
+    args = parser.parse_args(sys.argv[2:])
 
+    cfg = json.load(open(args.cfg))
+    checkLLVMConfigForBuild(cfg, args.type)
+    builddir = os.path.abspath(cfg["builds"][args.type]["path"])
+    logs = listBuildLogs(builddir)
+    if len(logs) == 0 and not args.log:
+      print("No build log at %s; build LLVM with `run.py build` first" % builddir)
+      exit(1)
+
+    logpath = args.log if args.log else logs[-1]
+    js = json.load(open(logpath))
+    sm = js["summary"]
+    print("Build at %s (commit %s, -j%d, targets: %s)" %
+          (js["time"], js["commit"], js["jobs"],
+           ",".join(js["targets"]) if len(js["targets"]) > 0 else "default"))
+    print("  Wall: %.1f sec., CPU: %.1f sec., average parallelism: %.1f" %
+          (sm["wall"], sm["cpu"], sm["parallelism"]))
+    for kind in sorted(sm["kinds"].keys()):
+      k = sm["kinds"][kind]
+      print("  %-8s %6d targets, %10.1f sec." % (kind, k["count"], k["cpu"]))
+
+    print("\nSlowest targets:")
+    for t in sm["targets"][:args.top]:
+      print("  %8.1f  %-8s %s" % (t["duration"], t["kind"], t["target"]))
+
+    # At most 20 rows
+    print("\nParallelism over time:")
+    timeline = sm["timeline"]
+    step = max(1, (len(timeline) + 19) // 20)
+    for i in range(0, len(timeline), step):
+      vals = [v for t, v in timeline[i:i + step]]
+      v = sum(vals) / len(vals)
+      print("  %7.0fs %5.1f %s" % (timeline[i][0], v, "#" * min(60, int(round(v)))))
+
+    durations = dict([(t["target"], t["duration"]) for t in sm["targets"]])
+    cp = sm["critical-path"]
+    print("\nCritical path (approximate; %d targets, %.1f sec.):" %
+          (len(cp), sum([durations[t] for t in cp])))
+    for t in sorted(cp, key=lambda t: -durations[t])[:args.top]:
+      print("  %8.1f  %s" % (durations[t], t))
+
+    againstpath = args.against
+    if not againstpath:
+      older = [l for l in logs if l < logpath]
+      older = [l for l in older if json.load(open(l))["cmake"] == js["cmake"]]
+      againstpath = older[-1] if len(older) > 0 else None
+    if not againstpath:
+      print("\nNo previous build with the same cmake options to compare with")
+      return
+
+    js2 = json.load(open(againstpath))
+    sm2 = js2["summary"]
+    print("\nDelta against the build at %s (commit %s):" %
+          (js2["time"], js2["commit"]))
+    print("  Wall: %+.1f sec. (%+.1f%%), CPU: %+.1f sec. (%+.1f%%)" %
+          (sm["wall"] - sm2["wall"], speedup(sm["wall"], sm2["wall"]),
+           sm["cpu"] - sm2["cpu"], speedup(sm["cpu"], sm2["cpu"])))
+    durations2 = dict([(t["target"], t["duration"]) for t in sm2["targets"]])
+    common = [t for t in durations if t in durations2]
+    print("  %d targets were built in both, %d only in this build, %d only in "
+          "the previous one" % (len(common), len(durations) - len(common),
+                                len(durations2) - len(common)))
+    deltas = sorted([(durations[t] - durations2[t], t) for t in common])
+    print("  Largest increases:")
+    for d, t in reversed(deltas[-args.top:]):
+      if d > 0:
+        print("  %+8.1f  %s" % (d, t))
+    print("  Largest decreases:")
+    for d, t in deltas[:args.top]:
+      if d < 0:
+        print("  %+8.1f  %s" % (d, t))
 
 
   ############################################################
@@ -545,6 +1193,12 @@ Type 'python3 run.py <command> help' to get details
 
     name = cfg["name"] if "name" in cfg else cfg["branch"]
 
+    if hasAndEquals(runcfg, "persistent", True):
+      # Reuse the directory that was built with the same configurations
+      assert("ramdisk" not in runcfg), "persistent cannot be used with ramdisk"
+      return "%s-%s-%s-persistent-%s%s" % (orgpath, name, runcfg["buildopt"],
+          self._getTestSuiteBuildKey(cfg, runcfg), path_suffix)
+
     if hasAndEquals(runcfg, "emitasm", True):
       testpath = "%s-%s-%s-asm%s" % (orgpath, name, runcfg["buildopt"],
                                      path_suffix)
@@ -564,15 +1218,71 @@ Type 'python3 run.py <command> help' to get details
            "Directory already exists: %s" % testpath
     return testpath
 
-  def _initCCScript(self, clang, clangpp, noopt, emitllvm):
+  # Key of a persistent test-suite build directory. Attributes of runcfg that
+  # do not affect how test-suite is built are excluded.
+  def _getTestSuiteBuildKey(self, cfg, runcfg):
+    ignored = ["threads", "build-threads", "iteration", "dropcache",
+               "disable_aslr", "set_scaling_governor", "resultsdb",
+               "adaptive", "pin-cores", "perf-events"]
+    key = {"build": cfg["builds"][runcfg["buildopt"]],
+           "repo": cfg["repo"] if "repo" in cfg else None,
+           "runcfg": dict([(k, v) for k, v in runcfg.items() if k not in ignored])}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:10]
+
+  # Returns (directory, maximum size in bytes) of the compile cache.
+  # cachecfg is true or {"dir": <path>, "max-size-mb": <size>}.
+  def _getCompileCache(self, cachecfg):
+    if not isinstance(cachecfg, dict):
+      cachecfg = dict()
+    cachedir = os.path.abspath(os.path.expanduser(cachecfg["dir"])) \
+               if "dir" in cachecfg else getCacheDir("compile")
+    os.makedirs(cachedir, exist_ok=True)
+    cachesize = cachecfg["max-size-mb"] if "max-size-mb" in cachecfg else 10240
+    return (cachedir, cachesize * (1 << 20))
+
+  # Creates compiler wrappers from cc.sh. If emit is True, the wrappers also
+  # emit assembly (or bitcode if emitllvm is True) next to object files.
+  # If cachecfg is given, outputs are cached by the compile cache.
+  # If singlepass is True, objects are built from the emitted files instead of
+  # compiling sources twice.
+  # If scriptdir is given, the wrappers are written there and are kept
+  # untouched if their contents are the same, so that make does not rebuild.
+  def _initCCScript(self, clang, clangpp, noopt, emitllvm, emit=True,
+                    cachecfg=None, singlepass=False, scriptdir=None):
     mydir = os.path.dirname(__file__)
     f = open(os.path.join(mydir, "cc.sh"), "r")
     contents = "".join(list(f.readlines()))
     f.close()
 
+    if cachecfg != None:
+      cachedir, cachesize = self._getCompileCache(cachecfg)
+      clanghash = fileHash(os.path.realpath(clang))
+      contents = contents.replace("[[CACHEDIR]]", cachedir) \
+                         .replace("[[CLANGHASH]]", clanghash)
+    else:
+      contents = contents.replace("[[CACHEDIR]]", "") \
+                         .replace("[[CLANGHASH]]", "")
+
+    if emit and singlepass:
+      contents = contents.replace("[[SINGLEPASS]]", "1")
+      if not emitllvm:
+        contents = contents.replace("[[OBJPARAM]]", "-c -x assembler")
+      elif noopt:
+        # Optimizations were not run yet
+        contents = contents.replace("[[OBJPARAM]]", "-c -x ir")
+      else:
+        contents = contents.replace("[[OBJPARAM]]",
+                                    "-c -x ir -Xclang -disable-llvm-passes")
+    else:
+      contents = contents.replace("[[SINGLEPASS]]", "") \
+                         .replace("[[OBJPARAM]]", "")
+
     def _update(ccc, clang):
       ccc = ccc.replace("[[CLANG]]", clang)
-      if emitllvm:
+      if not emit:
+        ccc = ccc.replace("[[PARAM]]", "")
+        ccc = ccc.replace("[[EXT]]", "o")
+      elif emitllvm:
         if noopt:
           ccc = ccc.replace("[[PARAM]]", "-c -emit-llvm -Xclang -disable-llvm-optzns")
         else:
@@ -586,51 +1296,129 @@ Type 'python3 run.py <command> help' to get details
         ccc = ccc.replace("[[EXT]]", "s")
       return ccc
 
-    hexcode = "".join([random.choice(string.ascii_letters) for n in range(8)])
-
-    ccpath = "/tmp/cc-%s.sh" % hexcode
-    ccc = _update(contents, clang)
-    f = open(ccpath, "w")
-    f.write(ccc)
-    f.close()
-    os.chmod(ccpath, 0o777)
-
-    cxxpath = "/tmp/cxx-%s.sh" % hexcode
-    ccc = _update(contents, clangpp)
-    f = open(cxxpath, "w")
-    f.write(ccc)
-    f.close()
-    os.chmod(cxxpath, 0o777)
+    if scriptdir:
+      ccpath = os.path.join(scriptdir, ".llvmscript-cc.sh")
+      cxxpath = os.path.join(scriptdir, ".llvmscript-cxx.sh")
+    else:
+      hexcode = "".join([random.choice(string.ascii_letters) for n in range(8)])
+      ccpath = "/tmp/cc-%s.sh" % hexcode
+      cxxpath = "/tmp/cxx-%s.sh" % hexcode
+
+    for path, compiler in [(ccpath, clang), (cxxpath, clangpp)]:
+      ccc = _update(contents, compiler)
+      if os.path.exists(path) and open(path, "r").read() == ccc:
+        continue
+      f = open(path, "w")
+      f.write(ccc)
+      f.close()
+      os.chmod(path, 0o777)
 
     return (ccpath, cxxpath)
 
-  # Build test-suite by running cmake and make
+  # Returns the CPUs that benchmarks are pinned to if pin-cores is set at
+  # runcfg, or None.
+  # pin-cores is true (all available cores), the number of cores, or a list
+  # of CPUs.
+  def _getPinnedCPUs(self, runcfg):
+    if runcfg["benchmark"] != True or "pin-cores" not in runcfg or \
+       runcfg["pin-cores"] == False:
+      return None
+    pin = runcfg["pin-cores"]
+    if isinstance(pin, list):
+      return pin
+    return getBenchmarkCPUs(None if pin == True else pin)
+
+  # Writes the wrapper that runs each benchmark on the CPU among cpus that its
+  # lit worker took, and logs the CPU to .llvmscript-cpus.log at testpath.
+  # If perfevents is not empty, they are counted with `perf stat`.
+  def _initRunUnderScript(self, testpath, cpus, perfevents=[]):
+    mydir = os.path.dirname(__file__)
+    contents = open(os.path.join(mydir, "rununder.sh"), "r").read()
+    contents = contents.replace("[[CPUS]]", " ".join([str(c) for c in cpus])) \
+                       .replace("[[PERFEVENTS]]", ",".join(perfevents)) \
+                       .replace("[[STATEDIR]]",
+                                os.path.join(testpath, ".llvmscript-cpus")) \
+                       .replace("[[LOG]]",
+                                os.path.join(testpath, ".llvmscript-cpus.log"))
+    path = os.path.join(testpath, ".llvmscript-rununder.sh")
+    if not (os.path.exists(path) and open(path, "r").read() == contents):
+      f = open(path, "w")
+      f.write(contents)
+      f.close()
+      os.chmod(path, 0o777)
+    return path
+
+  # Returns (# of build jobs, load limit or None) of building test-suite.
+  # If build-threads is not given, all cores are used unless compile time is
+  # measured.
+  def _getBuildThreads(self, runcfg):
+    load = runcfg["build-load"] if "build-load" in runcfg else None
+    if "build-threads" in runcfg:
+      return (runcfg["build-threads"], load)
+    if runcfg["benchmark"] == "compiletime":
+      return (1, load)
+    corecnt = multiprocessing.cpu_count()
+    return (corecnt, load if load else corecnt)
+
+  # Returns the environment of programs that test-suite builds and runs, or
+  # None to inherit the environment of run.py
+  def _getTestSuiteEnv(self, cfg, llvmdir):
+    if "libcxx" not in cfg["repo"]:
+      return None
+    env = dict(os.environ)
+    env["LD_LIBRARY_PATH"] = "%s/lib" % llvmdir
+    return env
+
+  # Build test-suite by running cmake and make (or ninja)
+  # If jobserver (a pair of pipe fds) is given, make takes job slots from it
+  # instead of using build-threads. Returns the exit code of make.
   def _buildTestSuiteUsingCMake(self, testpath, cfg, testcfg, runcfg, speccfg=None,
-                                runonly=None):
-    assert(not os.path.exists(testpath))
+                                runonly=None, jobserver=None):
+    persistent = hasAndEquals(runcfg, "persistent", True)
+    assert(persistent or not os.path.exists(testpath))
 
     llvmdir = cfg["builds"][runcfg["buildopt"]]["path"]
     clang = "%s/bin/clang" % llvmdir
     clangpp = clang + "++"
     llsize = "%s/bin/llvm-size" % llvmdir
 
+    scriptdir = None
+    if persistent:
+      os.makedirs(testpath, exist_ok=True)
+      scriptdir = testpath
+      clanghash = fileHash(os.path.realpath(clang))
+
     # Use cc.sh
+    cachecfg = runcfg["compile-cache"] if "compile-cache" in runcfg else None
+    if cachecfg == False:
+      cachecfg = None
+    if cachecfg != None and runcfg["benchmark"] == "compiletime":
+      # Cache hits would be measured as compile time
+      print("Warning: compile-cache is disabled when benchmarking compile-time")
+      cachecfg = None
+    singlepass = hasAndEquals(runcfg, "emit-singlepass", True)
     if "emitbc" in runcfg:
       (clang, clangpp) = self._initCCScript(clang, clangpp,
-          (True if runcfg["emitbc"] == "beforeopt" else False), True)
+          (True if runcfg["emitbc"] == "beforeopt" else False), True,
+          cachecfg=cachecfg, singlepass=singlepass, scriptdir=scriptdir)
     elif hasAndEquals(runcfg, "emitasm", True):
-      (clang, clangpp) = self._initCCScript(clang, clangpp, False, False)
+      (clang, clangpp) = self._initCCScript(clang, clangpp, False, False,
+                                            cachecfg=cachecfg,
+                                            singlepass=singlepass,
+                                            scriptdir=scriptdir)
+    elif cachecfg != None:
+      (clang, clangpp) = self._initCCScript(clang, clangpp, False, False,
+                                            emit=False, cachecfg=cachecfg,
+                                            scriptdir=scriptdir)
 
-    if "libcxx" in cfg["repo"]:
-      # Set LD_LIBRARY_PATH
-      os.putenv("LD_LIBRARY_PATH", "%s/lib" % llvmdir)
+    env = self._getTestSuiteEnv(cfg, llvmdir)
 
     cmakecache = "ReleaseNoLTO.cmake"
     if hasAndEquals(runcfg, "lto", True):
       assert(hasAndEquals(cfg["builds"][runcfg["buildopt"]], "use-lld", True)), "use-lld should be set to true"
       cmakecache = "ReleaseLTO.cmake"
 
-    os.makedirs(testpath)
+    os.makedirs(testpath, exist_ok=persistent)
     cmakeopt = ["cmake", "-DCMAKE_C_COMPILER=%s" % clang,
                          "-DCMAKE_CXX_COMPILER=%s" % clangpp,
                          "-DTEST_SUITE_LLVM_SIZE=%s" % llsize,
@@ -688,7 +1476,15 @@ Type 'python3 run.py <command> help' to get details
         print("TODO: Unsupported feature: use_cset")
         exit(1)
       else:
-        cmakeopt = cmakeopt + ["-DTEST_SUITE_RUN_UNDER=taskset -c 1"]
+        pinned = self._getPinnedCPUs(runcfg)
+        perfevents = getSupportedPerfEvents(runcfg["perf-events"]) \
+                     if "perf-events" in runcfg else []
+        if pinned or len(perfevents) > 0:
+          rununder = self._initRunUnderScript(testpath,
+              pinned if pinned else [1], perfevents)
+          cmakeopt = cmakeopt + ["-DTEST_SUITE_RUN_UNDER=%s" % rununder]
+        else:
+          cmakeopt = cmakeopt + ["-DTEST_SUITE_RUN_UNDER=taskset -c 1"]
 
       if hasAndEquals(runcfg, "use_perf", True):
         checkPerf()
@@ -704,56 +1500,258 @@ Type 'python3 run.py <command> help' to get details
     elif hasAndEquals(runcfg, "compileonly", True):
       cmakeopt = cmakeopt + ["-DTEST_SUITE_RUN_BENCHMARKS=0"]
 
+    ninja = hasAndEquals(runcfg, "generator", "ninja")
+    if ninja:
+      cmakeopt.append("-GNinja")
+
     cmakeopt.append(testcfg["test-suite-dir"])
 
+    # A persistent build directory records how it was configured and which
+    # clang built it, so that it is reconfigured or cleaned only if needed.
+    # The stamp does not end with .json, which would be read as results.
+    stamppath = os.path.join(testpath, ".llvmscript-build.stamp")
+    stamp = None
+    if persistent and os.path.exists(stamppath):
+      stamp = json.load(open(stamppath, "r"))
+
     # Run cmake.
-    p = Popen(cmakeopt, cwd=testpath)
-    p.wait()
+    if stamp and stamp["cmake"] == cmakeopt and \
+       os.path.exists(os.path.join(testpath, "CMakeCache.txt")):
+      print("Skipping cmake at %s" % testpath)
+    else:
+      p = Popen(cmakeopt, cwd=testpath, env=env)
+      p.wait()
+
+    if stamp and stamp["clang"] != clanghash:
+      # Objects built by the previous clang are stale
+      print("clang has changed; cleaning %s" % testpath)
+      Popen(["cmake", "--build", ".", "--target", "clean"], cwd=testpath,
+            env=env).wait()
 
     makedir = testpath
-    makeopt = ["make"]
-    corecnt = runcfg["build-threads"] if "build-threads" in runcfg else 1
-    makeopt.append("-j%d" % corecnt)
+    makeenv = env
+    corecnt, load = self._getBuildThreads(runcfg)
+    if ninja:
+      makeopt = ["ninja", "-j%d" % corecnt]
+      if jobserver:
+        # Ninja cannot join the jobserver; use half of the slots instead
+        makeopt = ["ninja", "-j%d" % max(1, corecnt // 2)]
+    else:
+      makeopt = ["make"]
+      if jobserver:
+        makeenv = dict(env if env else os.environ)
+        makeenv["MAKEFLAGS"] = makeJobserverFlags(jobserver)
+      else:
+        makeopt.append("-j%d" % corecnt)
+    if load:
+      makeopt.append("-l%d" % load)
 
     if runonly:
       if runonly.startswith("SingleSource"):
         # To be conservative, remove the last path
-        makedir = makedir + "/" + os.path.dirname(runonly)
+        subdir = os.path.dirname(runonly)
       else:
-        makedir = makedir + "/" + runonly
+        subdir = runonly
+      if ninja:
+        # Ninja builds every directory from the top; use the <dir>/all target
+        makeopt.append(subdir + "/all")
+      else:
+        makedir = makedir + "/" + subdir
 
-    print("Running make at %s" % makedir)
+    print("Running %s at %s" % (makeopt[0], makedir))
     # Run make.
-    p = Popen(makeopt, cwd=makedir)
+    p = Popen(makeopt, cwd=makedir, env=makeenv,
+              pass_fds=jobserver if jobserver and not ninja else ())
     p.wait()
 
+    if persistent and p.returncode == 0:
+      # A failed build is not up to date
+      json.dump({"cmake": cmakeopt, "clang": clanghash}, open(stamppath, "w"),
+                indent=2)
+    if cachecfg != None:
+      evictCompileCache(*self._getCompileCache(cachecfg))
+    return p.returncode
+
   # Runs llvm-lit.
-  def _runLit(self, testpath, llvmdir, runonly, corecnt, noExecute=False):
+  # runonly is a path relative to testpath, or a list of such paths.
+  # If filter is given, only tests whose names match the regex are run.
+  # If resnum is given, the results are written to results<resnum>.json.
+  # If out is given, the results are written to the file at testpath.
+  # env is the environment of llvm-lit (see _getTestSuiteEnv).
+  def _runLit(self, testpath, llvmdir, runonly, corecnt, noExecute=False,
+              filter=None, resnum=None, out=None, env=None):
     resjson_num = 1
     # The name of results.json
     while os.path.exists("%s/results%d.json" % (testpath, resjson_num)):
       resjson_num = resjson_num + 1
+    if resnum:
+      resjson_num = resnum
+    if out == None:
+      out = "results%d.json" % resjson_num
 
     args = ["%s/bin/llvm-lit" % llvmdir,
             "-s", # succinct
             "-j", str(corecnt), "--no-progress-bar",
-            "-o", "results%d.json" % resjson_num]
+            "-o", out]
     if noExecute:
       args.append("--no-execute")
+    if filter:
+      args = args + ["--filter", filter]
 
-    if runonly:
+    if isinstance(runonly, list):
+      args = args + [os.path.join(testpath, t) for t in runonly]
+    elif runonly:
       args.append(os.path.join(testpath, runonly))
     else:
       args.append(testpath)
 
+    cpulog = os.path.join(testpath, ".llvmscript-cpus.log")
+    for f in glob.glob(cpulog + "*"):
+      os.remove(f)
+    # Lit workers take CPUs again
+    cpustate = os.path.join(testpath, ".llvmscript-cpus")
+    shutil.rmtree(cpustate, ignore_errors=True)
+    os.makedirs(cpustate)
+
     print("Running lit: %s" % " ".join(args))
     print("\tat: %s" % testpath)
-    p = Popen(args, cwd=testpath)
+    p = Popen(args, cwd=testpath, env=env)
     p.wait()
 
-  # Run Test Suite using CMake
-  def _runTestSuiteUsingCMake(self, cfg, testcfg, runcfg, runonly,
-                              speccfg=None, path_suffix=None):
+    resjson = os.path.join(testpath, out)
+    if os.path.exists(cpulog) and os.path.exists(resjson):
+      self._addRunUnderMetrics(testpath, resjson, cpulog)
+
+  # Adds the CPU that each benchmark ran on (logged by .llvmscript-rununder.sh)
+  # to the results as the "cpu" metric, and perf counters if they were
+  # collected. Counters of an executable that ran several times are summed.
+  # If both instructions and cycles are counted, "ipc" is added as well.
+  def _addRunUnderMetrics(self, testpath, resjson, cpulog):
+    cpuof = dict()
+    countersof = dict()
+    for l in open(cpulog, "r"):
+      cpu, pid, cwd, exe = l.rstrip("\n").split("\t", 3)
+      exe = os.path.realpath(os.path.join(cwd, exe))
+      cpuof.setdefault(exe, int(cpu))
+      perfout = "%s.%s.perf" % (cpulog, pid)
+      if os.path.exists(perfout):
+        counters = countersof.setdefault(exe, dict())
+        for k, v in readPerfStat(perfout).items():
+          counters[k] = counters.get(k, 0.0) + v
+
+    js = json.load(open(resjson, "r"))
+    prefix = "test-suite :: "
+    matched = 0
+    for t in js["tests"]:
+      n = t["name"]
+      if not n.startswith(prefix) or not n.endswith(".test"):
+        continue
+      exe = os.path.realpath(os.path.join(testpath, n[len(prefix):-len(".test")]))
+      if exe in cpuof:
+        matched = matched + 1
+        t["metrics"]["cpu"] = cpuof[exe]
+      if exe in countersof:
+        counters = countersof[exe]
+        t["metrics"].update(counters)
+        if counters.get("cycles", 0.0) > 0.0 and "instructions" in counters:
+          t["metrics"]["ipc"] = counters["instructions"] / counters["cycles"]
+    if matched == 0 and len(cpuof) > 0:
+      # e.g. RUN_UNDER wraps timeit, so the wrapper sees timeit for every test
+      print("Warning: no test matched the commands run by .llvmscript-rununder.sh "
+            "(%s); cpu and perf metrics are not added" %
+            ", ".join(sorted(cpuof.keys())[:3]))
+    json.dump(js, open(resjson, "w"), indent=2)
+
+  # Re-runs benchmarks whose running times are not settled yet, i.e. the
+  # confidence interval of the median is wider than ci-target (relative to
+  # the median), until they have max-iteration samples or time-budget-sec
+  # passes since starttime. Benchmarks are run in chunks, and a chunk is not
+  # started if its estimated time (from the medians) exceeds the budget left.
+  def _runLitAdaptively(self, testpath, llvmdir, runonly, corecnt, runcfg,
+                        starttime, env=None):
+    adaptive = runcfg["adaptive"]
+    maxitr = adaptive["max-iteration"] if "max-iteration" in adaptive else 20
+    target = adaptive["ci-target"] if "ci-target" in adaptive else 0.01
+    budget = adaptive["time-budget-sec"] if "time-budget-sec" in adaptive else None
+
+    prefix = "test-suite :: "
+    while budget == None or time.time() - starttime < budget:
+      res = readRunningTimes(testpath)
+      unsettled = sorted([n for n, runs in res.items()
+                          if len(runs) < maxitr and n.startswith(prefix) and
+                             bootstrapRelativeCI(runs) > target])
+      print("%d/%d benchmarks are not settled" % (len(unsettled), len(res)))
+      if len(unsettled) == 0:
+        break
+
+      # A command-line argument cannot be longer than 128KB, and a chunk
+      # has at most 4 tests per thread so that the budget is checked often
+      chunksize = max(16, corecnt * 4)
+      while len(unsettled) > 0:
+        cnt = 0
+        length = 0
+        while cnt < len(unsettled) and cnt < chunksize and \
+              length + len(re.escape(unsettled[cnt])) < 100000:
+          length = length + len(re.escape(unsettled[cnt])) + 1
+          cnt = cnt + 1
+        cnt = max(cnt, 1)
+        chunk = unsettled[:cnt]
+        unsettled = unsettled[cnt:]
+
+        if budget != None:
+          estimate = sum([median(res[n]) for n in chunk]) / corecnt
+          if time.time() - starttime + estimate > budget:
+            print("Time budget is exhausted; %d benchmarks are left unsettled" %
+                  (len(chunk) + len(unsettled)))
+            return
+        if hasAndEquals(runcfg, "dropcache", True):
+          dropCache()
+        self._runLit(testpath, llvmdir, runonly, corecnt,
+                     filter="|".join([re.escape(n[len(prefix):]) + "$"
+                                      for n in chunk]), env=env)
+
+  # Merges results of llvm-lit runs at testpath (names in files) into out,
+  # and removes them
+  def _mergeLitResults(self, testpath, files, out):
+    merged = None
+    for f in files:
+      path = os.path.join(testpath, f)
+      if not os.path.exists(path):
+        continue
+      js = json.load(open(path, "r"))
+      if merged == None:
+        merged = js
+      else:
+        merged["tests"] = merged["tests"] + js["tests"]
+        if "elapsed" in merged and "elapsed" in js:
+          merged["elapsed"] = merged["elapsed"] + js["elapsed"]
+      os.remove(path)
+    if merged != None:
+      json.dump(merged, open(os.path.join(testpath, out), "w"), indent=2)
+
+  # Moves results of previous runs at a persistent build directory so that
+  # they are not mixed with new ones
+  def _movePreviousResults(self, testpath):
+    olds = glob.glob(os.path.join(testpath, "results*.json"))
+    if len(olds) > 0:
+      strnow = datetime.datetime.now().strftime("%m_%d_%H_%M_%S")
+      olddir = os.path.join(testpath, "previous-results", strnow)
+      os.makedirs(olddir)
+      for f in olds:
+        shutil.move(f, olddir)
+      print("Results of the previous run are moved to %s" % olddir)
+
+  # Stores results at testpath to the resultsdb of runcfg
+  def _storeResults(self, testpath, cfg, runcfg):
+    db = openResultsDB(runcfg["resultsdb"])
+    commit = cfg["commit"] if "commit" in cfg else \
+             (getGitCommit(cfg["src"]) if "src" in cfg else None)
+    runid = ingestResults(db, testpath, os.path.basename(testpath), cfg, runcfg,
+                          commit)
+    print("Results are stored at %s (run %d)" % (runcfg["resultsdb"], runid))
+
+  # Sets up the machine for running benchmarks as runcfg says
+  def _setUpMachine(self, runcfg):
     if hasAndEquals(runcfg, "dropcache", True):
       dropCache()
     if hasAndEquals(runcfg, "disable_aslr", True):
@@ -761,6 +1759,28 @@ Type 'python3 run.py <command> help' to get details
     if hasAndEquals(runcfg, "set_scaling_governor", True):
       setScalingGovernor()
 
+  # Returns the # of tests that llvm-lit runs at the same time
+  def _getLitThreads(self, runcfg):
+    corecnt = runcfg["threads"] if "threads" in runcfg else 1
+    pinned = self._getPinnedCPUs(runcfg)
+    if pinned:
+      # Each of the benchmarks running at the same time has its own core
+      corecnt = len(pinned)
+      print("Benchmarks are run on CPUs %s" % ",".join([str(c) for c in pinned]))
+    elif runcfg["benchmark"] == True:
+      if "threads" in runcfg and runcfg["threads"] != 1:
+        print("Warning: benchmark is set, but --threads is not 1!")
+
+    elif runcfg["benchmark"] == "compiletime":
+      if "build-threads" in runcfg and runcfg["build-threads"] != 1:
+        print("Warning: benchmarking compile-time, but --build-threads is not 1!")
+    return corecnt
+
+  # Run Test Suite using CMake
+  def _runTestSuiteUsingCMake(self, cfg, testcfg, runcfg, runonly,
+                              speccfg=None, path_suffix=None):
+    self._setUpMachine(runcfg)
+
 
     if "ramdisk" in runcfg:
       for f in glob.glob(runcfg["ramdisk"]):
@@ -783,6 +1803,9 @@ Type 'python3 run.py <command> help' to get details
     self._buildTestSuiteUsingCMake(testpath, cfg, testcfg, runcfg, speccfg=speccfg,
                                    runonly=runonly)
 
+    if hasAndEquals(runcfg, "persistent", True):
+      self._movePreviousResults(testpath)
+
     # Of iterations to run
     if hasAndEquals(runcfg, "emitasm", True) or "emitbc" in runcfg:
       # No need to run llvm-lit
@@ -791,20 +1814,28 @@ Type 'python3 run.py <command> help' to get details
       itrcnt = runcfg["iteration"] if "iteration" in runcfg else 1
 
     llvmdir = cfg["builds"][runcfg["buildopt"]]["path"]
-    corecnt = runcfg["threads"] if "threads" in runcfg else 1
-    if runcfg["benchmark"] == True:
-      if "threads" in runcfg and runcfg["threads"] != 1:
-        print("Warning: benchmark is set, but --threads is not 1!")
+    corecnt = self._getLitThreads(runcfg)
 
-    elif runcfg["benchmark"] == "compiletime":
-      if "build-threads" in runcfg and runcfg["build-threads"] != 1:
-        print("Warning: benchmarking compile-time, but --build-threads is not 1!")
+    adaptive = None
+    if runcfg["benchmark"] == True and "adaptive" in runcfg:
+      adaptive = runcfg["adaptive"]
+      itrcnt = adaptive["min-iteration"] if "min-iteration" in adaptive else 3
 
+    env = self._getTestSuiteEnv(cfg, llvmdir)
+    starttime = time.time()
     for itr in range(0, itrcnt):
       runonly = runonly if runonly else "."
       if hasAndEquals(runcfg, "dropcache", True):
         dropCache()
-      self._runLit(testpath, llvmdir, runonly, corecnt)
+      self._runLit(testpath, llvmdir, runonly, corecnt, env=env)
+
+    if adaptive:
+      self._runLitAdaptively(testpath, llvmdir, runonly, corecnt, runcfg,
+                             starttime, env)
+
+    if itrcnt > 0 and "resultsdb" in runcfg:
+      self._storeResults(testpath, cfg, runcfg)
+    return testpath
 
 
   ##
@@ -820,6 +1851,9 @@ This runs programs that are not written in C/C++ as well.
     parser.add_argument('--runonly',
         help='Run a specified test only (e.g. SingleSource/Benchmarks/Shootout)',
         action='store', required=False)
+    parser.add_argument('--commit', action='store',
+        help='Use the toolchain of this LLVM commit from build-cache instead '
+             'of the build at cfg (built if it is not cached)')
     args = parser.parse_args(sys.argv[2:])
 
     cfg = json.load(open(args.cfg))
@@ -828,6 +1862,8 @@ This runs programs that are not written in C/C++ as well.
     runonly = args.runonly if args.runonly else None
 
     checkRunConfig(runcfg, args.runcfg)
+    if args.commit:
+      cfg = self._getCommitConfig(cfg, runcfg["buildopt"], args.commit)
 
     self._runTestSuiteUsingCMake(cfg, testcfg, runcfg, runonly)
 
@@ -836,6 +1872,53 @@ This runs programs that are not written in C/C++ as well.
       sendMail(cfg, "test", str(args))
 
 
+  # Builds two test-suites concurrently. They share build-threads job slots
+  # through a jobserver; each make has one implicit slot.
+  # poll is called every 30 seconds while building. Exits if either of them
+  # fails.
+  def _buildTwoTestSuites(self, testpath1, cfg1, testpath2, cfg2, testcfg,
+                          runcfg, speccfg, runonly, poll=None):
+    buildthreads, load = self._getBuildThreads(runcfg)
+    jobserver = os.pipe()
+    os.write(jobserver[1], b"+" * max(0, buildthreads - 2))
+
+    # The exit code of make, or the exception raised while building
+    results = dict()
+    def _build(testpath, cfg):
+      try:
+        results[testpath] = self._buildTestSuiteUsingCMake(
+            testpath, cfg, testcfg, runcfg, speccfg, runonly, jobserver=jobserver)
+      except BaseException as e:
+        results[testpath] = e
+
+    threads = [threading.Thread(target=_build, args=(testpath, cfg))
+               for testpath, cfg in [(testpath1, cfg1), (testpath2, cfg2)]]
+    for t in threads:
+      t.start()
+    while any([t.is_alive() for t in threads]):
+      # Join one that is still running, so that poll is called every 30 secs
+      [t for t in threads if t.is_alive()][0].join(30)
+      if poll:
+        poll()
+    for t in threads:
+      t.join()
+
+    os.close(jobserver[0])
+    os.close(jobserver[1])
+
+    failed = False
+    for testpath in [testpath1, testpath2]:
+      res = results.get(testpath)
+      if isinstance(res, BaseException) and not isinstance(res, SystemExit):
+        print("Building test-suite at %s raised %s: %s" %
+              (testpath, type(res).__name__, res))
+        failed = True
+      elif res != 0:
+        print("Building test-suite at %s failed" % testpath)
+        failed = True
+    if failed:
+      exit(1)
+
   # Get the list of tests by running `llvm-lit --show-tests`
   def _getTestList(self, testpath, llvmdir):
     cmds = ["%s/bin/llvm-lit" % llvmdir, "--show-tests", testpath]
@@ -868,20 +1951,47 @@ Infos about LLVMs should be given with --cfg and --cfg2.
 The list of different assembly files is printed at the file specified by --out.
 """,
         llvm=True, llvm2=True, testsuite=True, run=True,
-        spec=True, sendmail=True, optionals=["sendmail", "testsuite", "spec"])
+        spec=True, sendmail=True,
+        optionals=["sendmail", "testsuite", "spec", "llvm2"])
+    parser.add_argument('--commit', action='store',
+        help='Use the toolchain of this LLVM commit from build-cache instead '
+             'of the build at --cfg (built if it is not cached)')
+    parser.add_argument('--commit2', action='store',
+        help='Same as --commit, for --cfg2 (default: --cfg)')
     parser.add_argument('--prebuilt', action="store",
         help='Use pre-built test-suites to generate diff (format: dir1,dir2)')
     parser.add_argument('--out', help='Output file path', required=True,
                         action='store')
     parser.add_argument('--runonly', action="store",
         help='Only run this benchmark')
+    parser.add_argument('--jobs', action="store", type=int,
+        help='# of processes to use for diffing (default: threads at runcfg)')
+    parser.add_argument('--funcdiff', action="store",
+        help='Write changed functions of assembly files to this json file')
     args = parser.parse_args(sys.argv[2:])
 
+    if not args.cfg2 and not args.commit2:
+      print("Either --cfg2 or --commit2 should be given")
+      exit(1)
     cfg1 = json.load(open(args.cfg))
-    cfg2 = json.load(open(args.cfg2))
+    cfg2 = json.load(open(args.cfg2 if args.cfg2 else args.cfg))
     runcfg = json.load(open(args.runcfg))
     outf = open(args.out, "w")
     emitasm = hasAndEquals(runcfg, "emitasm", True)
+    if args.commit:
+      cfg1 = self._getCommitConfig(cfg1, runcfg["buildopt"], args.commit)
+    if args.commit2:
+      cfg2 = self._getCommitConfig(cfg2, runcfg["buildopt"], args.commit2)
+
+    corecnt = multiprocessing.cpu_count()
+    if args.runcfg:
+      corecnt = runcfg["threads"] if "threads" in runcfg else 1
+    jobs = args.jobs if args.jobs else corecnt
+
+    llvmdir1 = cfg1["builds"][runcfg["buildopt"]]["path"]
+    llvmdir2 = cfg2["builds"][runcfg["buildopt"]]["path"]
+    llvmdis1 = "%s/bin/llvm-dis" % llvmdir1
+    llvmdis2 = "%s/bin/llvm-dis" % llvmdir2
 
     if args.prebuilt:
       paths = args.prebuilt.split(',')
@@ -915,15 +2025,19 @@ The list of different assembly files is printed at the file specified by --out.
             exit(1)
           runonly = "External/SPEC/" + runonly
 
-      self._buildTestSuiteUsingCMake(testpath1, cfg1, testcfg, runcfg, speccfg, runonly)
-      self._buildTestSuiteUsingCMake(testpath2, cfg2, testcfg, runcfg, speccfg, runonly)
+      # Files that are built at both directories are normalized while building
+      pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+      def _warm():
+        if os.path.exists(testpath1) and os.path.exists(testpath2):
+          with tracePhase("warmDigests"):
+            warmDigests(testpath1, testpath2, emitasm, pool, llvmdis1, llvmdis2)
+      self._buildTwoTestSuites(testpath1, cfg1, testpath2, cfg2, testcfg, runcfg,
+                               speccfg, runonly, poll=_warm)
 
-    corecnt = multiprocessing.cpu_count()
-    if args.runcfg:
-      corecnt = runcfg["threads"] if "threads" in runcfg else 1
+      if pool:
+        pool.close()
+        pool.join()
 
-    llvmdir1 = cfg1["builds"][runcfg["buildopt"]]["path"]
-    llvmdir2 = cfg2["builds"][runcfg["buildopt"]]["path"]
     # This is needed to get test list
     self._runLit(testpath1, llvmdir1, None, corecnt, noExecute=True)
     self._runLit(testpath2, llvmdir2, None, corecnt, noExecute=True)
@@ -934,23 +2048,318 @@ The list of different assembly files is printed at the file specified by --out.
     # Diff all .s files
     print(testpath1)
     print(testpath2)
-    diffDirs(testpath1, testpath2, emitasm, outf)
+    with tracePhase("diffDirs"):
+      diffDirs(testpath1, testpath2, emitasm, outf, jobs, llvmdis1, llvmdis2,
+               args.funcdiff)
     if args.mailcfg:
       cfg = json.load(open(args.mailcfg, "r"))
       sendMail(cfg, "diff", str(args))
 
 
+  ##
+  # Run test-suite with two LLVMs in interleaved order
+  ##
+  def abtest(self):
+    parser = newParser("abtest", desc="""
+Builds test-suite with two different LLVMs (--cfg and --cfg2) and runs their
+benchmarks in interleaved order: benchmarks are split into chunks of --chunk
+tests, and each chunk is run with both LLVMs back to back, so that drift of
+the machine slower than a chunk affects both alike.
+Results of the N-th round are written to resultsN.json of both directories;
+compare them with "paired": true at --comparecfg of compare.
+""",
+        llvm=True, llvm2=True, testsuite=True, run=True,
+        spec=True, sendmail=True, optionals=["sendmail", "spec"])
+    parser.add_argument('--runonly',
+        help='Run a specified test only (e.g. SingleSource/Benchmarks/Shootout)',
+        action='store', required=False)
+    parser.add_argument('--rounds', action="store", type=int,
+        help='# of rounds (default: iteration at runcfg)')
+    parser.add_argument('--order', action="store", choices=["random", "abba"],
+        default="random",
+        help='Order of the two LLVMs for each chunk: random, or AB, BA, AB, ...')
+    parser.add_argument('--chunk', action="store", type=int,
+        help='# of tests that are run with an LLVM before switching to the '
+             'other one (default: 4 per thread, at least 16)')
+    parser.add_argument('--seed', action="store", type=int,
+        help='Seed of the random order')
+    args = parser.parse_args(sys.argv[2:])
+
+    cfg1 = json.load(open(args.cfg))
+    cfg2 = json.load(open(args.cfg2))
+    testcfg = json.load(open(args.testcfg))
+    runcfg = json.load(open(args.runcfg))
+    speccfg = json.load(open(args.speccfg)) if args.speccfg else None
+
+    checkRunConfig(runcfg, args.runcfg)
+    if runcfg["benchmark"] != True:
+      print("abtest needs \"benchmark\": true at the run config")
+      exit(1)
+    if "ramdisk" in runcfg:
+      print("ramdisk is not allowed for abtest")
+      exit(1)
+
+    testpath1 = self._getTestSuiteBuildPath(cfg1, testcfg, runcfg)
+    testpath2 = self._getTestSuiteBuildPath(cfg2, testcfg, runcfg)
+    assert(testpath1 != testpath2), "Build output paths are identical (%s)" % testpath1
+    print("++ Path (A): %s" % testpath1)
+    print("++ Path (B): %s" % testpath2)
+
+    self._setUpMachine(runcfg)
+    self._buildTwoTestSuites(testpath1, cfg1, testpath2, cfg2, testcfg, runcfg,
+                             speccfg, args.runonly)
+    if hasAndEquals(runcfg, "persistent", True):
+      self._movePreviousResults(testpath1)
+      self._movePreviousResults(testpath2)
+
+    rounds = args.rounds if args.rounds else \
+             (runcfg["iteration"] if "iteration" in runcfg else 1)
+    corecnt = self._getLitThreads(runcfg)
+    runonly = args.runonly if args.runonly else "."
+    sides = [(testpath1, cfg1["builds"][runcfg["buildopt"]]["path"]),
+             (testpath2, cfg2["builds"][runcfg["buildopt"]]["path"])]
+    envs = [self._getTestSuiteEnv(cfg1, sides[0][1]),
+            self._getTestSuiteEnv(cfg2, sides[1][1])]
+
+    prefix = runonly.rstrip("/") + "/" if runonly != "." else ""
+    tests = [t for t in self._getTestList(testpath1, sides[0][1])
+             if t.startswith(prefix)]
+    if len(tests) == 0:
+      print("No tests to run at %s" % os.path.join(testpath1, runonly))
+      exit(1)
+    # Each chunk starts llvm-lit for each LLVM, so a chunk should be long
+    # enough to hide the startup of lit
+    chunksize = args.chunk if args.chunk else max(16, corecnt * 4)
+    chunks = [tests[i:i + chunksize] for i in range(0, len(tests), chunksize)]
+    print("%d tests are run in %d chunks per round" % (len(tests), len(chunks)))
+
+    rng = random.Random(args.seed)
+    for r in range(0, rounds):
+      order = []
+      for k, chunk in enumerate(chunks):
+        if args.order == "abba":
+          # Alternates over chunks and over rounds
+          ab = [0, 1] if (r + k) % 2 == 0 else [1, 0]
+        else:
+          ab = rng.sample([0, 1], 2)
+        order.append("".join(["AB"[i] for i in ab]))
+        for i in ab:
+          if hasAndEquals(runcfg, "dropcache", True):
+            dropCache()
+          # lit loads the tests of the chunk only, instead of discovering all
+          # tests at runonly
+          self._runLit(sides[i][0], sides[i][1], chunk, corecnt,
+                       out=".llvmscript-abtest-%d.json" % k, env=envs[i])
+      print("Round %d/%d: %s" % (r + 1, rounds, " ".join(order)))
+      for testpath, llvmdir in sides:
+        self._mergeLitResults(testpath,
+                              [".llvmscript-abtest-%d.json" % k
+                               for k in range(0, len(chunks))],
+                              "results%d.json" % (r + 1))
+
+    if "resultsdb" in runcfg:
+      self._storeResults(testpath1, cfg1, runcfg)
+      self._storeResults(testpath2, cfg2, runcfg)
+
+    print("Paired results: %s, %s" % (testpath1, testpath2))
+    if args.mailcfg:
+      cfg = json.load(open(args.mailcfg, "r"))
+      sendMail(cfg, "abtest", str(args))
+
+
+  ##
+  # Bisect a performance regression over LLVM commits
+  ##
+  def bisect(self):
+    parser = newParser("bisect", desc="""
+Finds the first LLVM commit between --good and --bad whose benchmarks are
+worse than those of --good by more than --threshold (%).
+At each commit, the toolchain is taken from build-cache (see README) or
+built at a separate worktree and build directory (<src>-buildcache,
+<path>-buildcache), and test-suite is built and run for --runonly with it.
+Results of visited commits are kept at <path>-bisect-state and are reused
+by later bisections.
+""",
+        llvm=True, testsuite=True, run=True, sendmail=True,
+        optionals=["sendmail"])
+    parser.add_argument('--good', action='store', required=True,
+        help='A commit that does not have the regression')
+    parser.add_argument('--bad', action='store', required=True,
+        help='A commit that has the regression')
+    parser.add_argument('--runonly', action='store', required=True,
+        help='Benchmarks to run (e.g. SingleSource/Benchmarks/Shootout)')
+    parser.add_argument('--metric', action='store', default="exec_time",
+        help='Metric to compare (default: exec_time)')
+    parser.add_argument('--threshold', action='store', type=float, default=2.0,
+        help='A commit is bad if the geomean of the metric is larger than that '
+             'of --good by more than this (%%) and the change is significant; '
+             'if negative, smaller by more than its absolute value '
+             '(default: 2.0)')
+    parser.add_argument('--alpha', action='store', type=float, default=0.05,
+        help='A change is significant if the (1 - alpha) confidence interval '
+             'of the change does not include 0 (default: 0.05)')
+    parser.add_argument('--core', action='store', type=int,
+        help='# of cores to build LLVM (default: all)')
+    args = parser.parse_args(sys.argv[2:])
+
+    cfg = json.load(open(args.cfg))
+    testcfg = json.load(open(args.testcfg))
+    runcfg = json.load(open(args.runcfg))
+    checkRunConfig(runcfg, args.runcfg)
+    if "iteration" not in runcfg or runcfg["iteration"] < 3:
+      print("Warning: iteration at the run config is less than 3; the "
+            "significance of changes cannot be tested well")
+    if hasAndEquals(runcfg, "emitasm", True) or "emitbc" in runcfg:
+      print("emitasm and emitbc are not allowed for bisect")
+      exit(1)
+    key = "exec_time" if args.metric == "exectime" else args.metric
+
+    src = os.path.abspath(cfg["src"])
+    _git = lambda cmds: Popen(["git"] + cmds, cwd=src, stdout=subprocess.PIPE) \
+                         .communicate()[0].decode("utf-8").strip()
+    good = _git(["rev-parse", "--verify", args.good + "^{commit}"])
+    bad = _git(["rev-parse", "--verify", args.bad + "^{commit}"])
+    if not good or not bad:
+      print("Unknown commit: %s" % (args.bad if good else args.good))
+      exit(1)
+    # Commits after good, up to bad
+    commits = _git(["rev-list", "--first-parent", "--reverse",
+                    "%s..%s" % (good, bad)]).split()
+    if len(commits) == 0 or commits[-1] != bad:
+      print("%s is not an ancestor of %s" % (args.good, args.bad))
+      exit(1)
+    print("Bisecting %d commits" % len(commits))
+
+    buildopt = runcfg["buildopt"]
+    buildpath = os.path.abspath(cfg["builds"][buildopt]["path"])
+    statedir = buildpath + "-bisect-state"
+    os.makedirs(statedir, exist_ok=True)
+    statepath = os.path.join(statedir, "bisect.json")
+    state = json.load(open(statepath)) if os.path.exists(statepath) else \
+            {"results": {}, "broken": []}
+    runkey = hashlib.sha1(json.dumps([args.runonly, runcfg, testcfg],
+                                     sort_keys=True).encode("utf-8")).hexdigest()
+
+    # Returns test name -> metric values of commit, or None if LLVM cannot be
+    # built at the commit
+    def _results(commit):
+      rkey = "%s-%s" % (commit, runkey)
+      if rkey in state["results"] and os.path.exists(state["results"][rkey]):
+        print("Reusing the results of %s" % commit[:12])
+        return readJsonResults(state["results"][rkey], key)
+      if commit in state["broken"]:
+        return None
+
+      toolchain = self._getCachedToolchain(cfg, buildopt, commit, args.core)
+      if toolchain == None:
+        state["broken"].append(commit)
+        json.dump(state, open(statepath, "w"), indent=2)
+        return None
+
+      cfg2 = dict(cfg)
+      cfg2["name"] = "%s-bisect-%s" % (cfg["name"] if "name" in cfg else
+                                       cfg["branch"], commit[:12])
+      cfg2["commit"] = commit
+      cfg2["builds"] = {buildopt: dict(cfg["builds"][buildopt])}
+      cfg2["builds"][buildopt]["path"] = toolchain
+      testpath = self._runTestSuiteUsingCMake(cfg2, testcfg, runcfg, args.runonly)
+      state["results"][rkey] = testpath
+      json.dump(state, open(statepath, "w"), indent=2)
+      return readJsonResults(testpath, key)
+
+    base = _results(good)
+    if base == None or len(base) == 0:
+      print("Cannot get %s of %s at %s" % (key, args.runonly, good))
+      exit(1)
+
+    # Returns the change (%) of geomean of the metric from good, and its
+    # confidence interval (low, high)
+    def _change(res):
+      ratios = []
+      samples = []
+      for n in sorted(base.keys()):
+        if n not in res or median(base[n]) == 0.0 or median(res[n]) == 0.0:
+          continue
+        pvalue = mannWhitneyU(base[n], res[n])
+        print("  %s: %+.2f%% (p-value %.3f)" %
+              (n, speedup(median(res[n]), median(base[n])), pvalue))
+        ratios.append(median(res[n]) / median(base[n]))
+        samples.append((base[n], res[n]))
+      if len(ratios) == 0:
+        return (0.0, 0.0, 0.0)
+      lo, hi = bootstrapGeomeanChangeCI(samples, confidence=1.0 - args.alpha)
+      return ((geomean(ratios) - 1.0) * 100, lo, hi)
+
+    # A commit is bad if the change passes the threshold and the confidence
+    # interval of the change does not include 0, i.e. it is not noise
+    def _isBad(commit):
+      res = _results(commit)
+      if res == None:
+        print("%s cannot be built; skipping it" % commit[:12])
+        return None
+      change, lo, hi = _change(res)
+      if args.threshold >= 0:
+        isbad = change > args.threshold and lo > 0.0
+      else:
+        isbad = change < args.threshold and hi < 0.0
+      significant = lo > 0.0 or hi < 0.0
+      print("%s: %s %+.2f%% (%d%% CI: %+.2f%% ~ %+.2f%%%s) -> %s" %
+            (commit[:12], key, change, round((1.0 - args.alpha) * 100), lo, hi,
+             "" if significant else ", not significant",
+             "bad" if isbad else "good"))
+      return isbad
+
+    if _isBad(bad) != True:
+      print("%s does not have the regression" % args.bad)
+      exit(1)
+
+    # commits[lo] is good (-1: good) and commits[hi] is bad
+    lo = -1
+    hi = len(commits) - 1
+    while hi - lo > 1:
+      mid = (lo + hi) // 2
+      # Skip commits that cannot be built
+      candidates = list(range(mid, hi)) + list(range(mid - 1, lo, -1))
+      result = None
+      for c in candidates:
+        result = _isBad(commits[c])
+        if result != None:
+          break
+      if result == None:
+        break
+      if result:
+        hi = c
+      else:
+        lo = c
+
+    if hi - lo > 1:
+      print("The first bad commit is one of the following (others cannot be built):")
+      for c in commits[lo + 1:hi + 1]:
+        print("  " + _git(["log", "-1", "--format=%H %s", c]))
+    else:
+      print("The first bad commit is:")
+      print("  " + _git(["log", "-1", "--format=%H %s", commits[hi]]))
+
+    if args.mailcfg:
+      mcfg = json.load(open(args.mailcfg, "r"))
+      sendMail(mcfg, "bisect", str(args))
+
+
   def compare(self):
     parser = newParser("compare", desc="""
 Compares performance results of test-suite results.
 Two directories containing results (resultN.json) should be specified with
---dir1 and --dir2.
+--dir1 and --dir2, or two runs at a results database with --db, --run1 and
+--run2.
 The output is printed in csv format to the file specified by --out.
 To give additional parameters for pruning out highly fluctuated results or
 short tests, use --comparecfg.
 """)
-    parser.add_argument('--dir1', required=True, action="store", help='Result dir 1')
-    parser.add_argument('--dir2', required=True, action="store", help='Result dir 2')
+    parser.add_argument('--dir1', action="store", help='Result dir 1')
+    parser.add_argument('--dir2', action="store", help='Result dir 2')
+    parser.add_argument('--db', action="store", help='Results database')
+    parser.add_argument('--run1', action="store", type=int, help='Run id 1 at --db')
+    parser.add_argument('--run2', action="store", type=int, help='Run id 2 at --db')
     parser.add_argument('--comparecfg', action="store", required=True,
                         help="Configurations for fine-grained filtering control")
     parser.add_argument('--out', help='Output file path', required=True,
@@ -959,27 +2368,61 @@ short tests, use --comparecfg.
     # options for fine-grained control of filtering results.
     args = parser.parse_args(sys.argv[2:])
 
+    if args.db:
+      assert(args.run1 != None and args.run2 != None), \
+             "--run1 and --run2 should be given with --db"
+      db = openResultsDB(args.db)
+      _read = lambda run, dir, key: readDBResults(db, run, key)
+    else:
+      assert(args.dir1 and args.dir2), "--dir1 and --dir2 should be given"
+      _read = lambda run, dir, key: readJsonResults(dir, key)
+
     mintime = 0.0
     tolerance = 1
+    alpha = 0.05
+    bootstrap = 1000
     comparecfg = json.load(open(args.comparecfg))
 
     assert("collect" in comparecfg)
 
-    if comparecfg["collect"] == "exectime":
-      if "minimum-runtime-sec" in comparecfg:
+    if comparecfg["collect"] != "objsize":
+      # exectime, or any metric at the results such as perf counters
+      # (cycles, instructions, ipc, ...)
+      collect = comparecfg["collect"]
+      key = "exec_time" if collect == "exectime" else collect
+      if "minimum-runtime-sec" in comparecfg and collect == "exectime":
         mintime = comparecfg["minimum-runtime-sec"]
       if "tolerance" in comparecfg:
         tolerance = comparecfg["tolerance"]
-      res1 = readRunningTimes(args.dir1)
-      res2 = readRunningTimes(args.dir2)
-
-      assert(set(res1.keys()) == set(res2.keys())), \
-             "The list of tests does not match."
+      if "significance" in comparecfg:
+        alpha = comparecfg["significance"]
+      if "bootstrap" in comparecfg:
+        bootstrap = comparecfg["bootstrap"]
+      paired = hasAndEquals(comparecfg, "paired", True)
+      if paired:
+        # Results of the same resultN.json at the two directories are pairs
+        assert(not args.db), "paired cannot be used with --db"
+        pairs = readPairedResults(args.dir1, args.dir2, key)
+        res1 = dict([(k, [a for a, b in v]) for k, v in pairs.items()])
+        res2 = dict([(k, [b for a, b in v]) for k, v in pairs.items()])
+      else:
+        res1 = _read(args.run1, args.dir1, key)
+        res2 = _read(args.run2, args.dir2, key)
 
-      def _median(runs):
-        l = len(runs)
-        return runs[int(l / 2)] if l % 2 == 1 else \
-              (runs[int(l / 2)] + runs[int((l+1) / 2)]) / 2
+      if len(res1) == 0 or len(res2) == 0:
+        print("No results have %s%s" % (key, "" if collect == "exectime" else
+              "; was it given as perf-events at the run config?"))
+        exit(1)
+      if collect == "exectime":
+        assert(set(res1.keys()) == set(res2.keys())), \
+               "The list of tests does not match."
+      elif set(res1.keys()) != set(res2.keys()):
+        # Counters may not be available for some tests
+        common = set(res1.keys()) & set(res2.keys())
+        print("%d tests that do not have %s at both results are skipped" %
+              (len(set(res1.keys()) | set(res2.keys())) - len(common), key))
+        res1 = dict([(k, v) for k, v in res1.items() if k in common])
+        res2 = dict([(k, v) for k, v in res2.items() if k in common])
 
       def _filter(runs, med):
         if med == 0.0:
@@ -988,37 +2431,83 @@ short tests, use --comparecfg.
                (max(med - runs[0], runs[-1] - med) / med < tolerance)
 
       aggregated_result = []
-      trials = None
-      for k in res1.keys():
+      # The number of samples may differ if benchmarks were run adaptively
+      trials = max([len(r) for r in list(res1.values()) + list(res2.values())] + [0])
+      _pad = lambda runs: runs + [""] * (trials - len(runs))
+      filtered = 0
+      bysuite = dict()
+      for k in sorted(res1.keys()):
         runs1 = res1[k]
         runs2 = res2[k]
-        assert(len(runs1) == len(runs2))
-        if trials == None:
-          trials = len(runs1)
-        runs1.sort()
-        runs2.sort()
-        med1 = _median(runs1)
-        med2 = _median(runs2)
-
-        if not _filter(runs1, med1) or not _filter(runs2, med2):
+        if not paired:
+          # Paired runs are kept in the order of rounds
+          runs1.sort()
+          runs2.sort()
+        med1 = median(runs1)
+        med2 = median(runs2)
+
+        if not _filter(sorted(runs1), med1) or not _filter(sorted(runs2), med2):
+          filtered = filtered + 1
           continue
 
-        speedup = 0.0 if med2 == 0.0 else ((med1 - med2) / med2 * 100)
-        aggregated_result.append([k] + runs1 + [med1] + runs2 + [med2] + [speedup])
+        # For metrics other than exectime, the change of the second one from
+        # the first one is computed as the speedup of the first one
+        if paired:
+          pairsk = pairs[k] if collect == "exectime" else \
+                   [(b, a) for a, b in pairs[k]]
+          speedup_ = pairedSpeedup(pairsk)
+          cilo, cihi = bootstrapPairedSpeedupCI(pairsk, bootstrap)
+          pvalue = wilcoxonSignedRank(pairsk)
+        elif collect == "exectime":
+          speedup_ = speedup(med1, med2)
+          cilo, cihi = bootstrapSpeedupCI(runs1, runs2, bootstrap)
+          pvalue = mannWhitneyU(runs1, runs2)
+        else:
+          speedup_ = speedup(med2, med1)
+          cilo, cihi = bootstrapSpeedupCI(runs2, runs1, bootstrap)
+          pvalue = mannWhitneyU(runs2, runs1)
+        # Flag instead of dropping results that may be noise
+        significant = pvalue < alpha and (cilo > 0.0 or cihi < 0.0)
+        aggregated_result.append([k] + _pad(runs1) + [med1] + _pad(runs2) + [med2] +
+                                 [cilo, cihi, pvalue,
+                                  "yes" if significant else "no", speedup_])
+
+        if med1 > 0.0 and med2 > 0.0:
+          bysuite.setdefault(suiteOf(k), []).append(
+              med1 / med2 if collect == "exectime" else med2 / med1)
+
+      if filtered > 0:
+        print("%d tests were filtered out by minimum-runtime-sec or tolerance" %
+              filtered)
 
       aggregated_result.sort(key=lambda k: k[-1])
       fhand = open(args.out, 'w')
       w = csv.writer(fhand)
+      # For metrics other than exectime, a positive change means that the
+      # metric of the second one is larger
+      medname = "Median (sec.)" if collect == "exectime" else "Median"
+      changename = "Speedup(%)" if collect == "exectime" else "%s change(%%)" % key
       w.writerow(["Name"] + ["Itr%d" % x for x in range(1, trials+1)] +
-                 ["Median (sec.)"] + ["Itr%d" % x for x in range(1, trials+1)] +
-                 ["Median (sec.)", "Speedup(%)"])
+                 [medname] + ["Itr%d" % x for x in range(1, trials+1)] +
+                 [medname, "CI low(%)", "CI high(%)", "p-value",
+                  "Significant", changename])
       for row in aggregated_result:
         w.writerow(row)
+
+      # Geomean speedup per suite
+      w.writerow([])
+      w.writerow(["Suite", "# of tests", "Geomean " + changename.lower()])
+      for suite in sorted(bysuite.keys()):
+        gm = (geomean(bysuite[suite]) - 1.0) * 100
+        print("%s: geomean %s %.3f%% (%d tests)" %
+              (suite, "speedup" if collect == "exectime" else key + " change",
+               gm, len(bysuite[suite])))
+        w.writerow([suite, len(bysuite[suite]), gm])
       fhand.close()
 
     elif comparecfg["collect"] == "objsize":
-      res1 = readObjSizes(args.dir1)
-      res2 = readObjSizes(args.dir2)
+      res1 = _read(args.run1, args.dir1, "size")
+      res2 = _read(args.run2, args.dir2, "size")
 
       assert(set(res1.keys()) == set(res2.keys())), \
              "The list of tests does not match."
@@ -1046,6 +2535,53 @@ short tests, use --comparecfg.
       fhand.close()
 
 
+  ############################################################
+  #             Store results to a database
+  ############################################################
+  def ingest(self):
+    parser = newParser("ingest", desc="""
+Stores test-suite results (resultN.json) at a directory to a results database.
+Results are automatically stored after running test-suite if the run config
+has "resultsdb".
+""",
+                       llvm=True, run=True, optionals=["llvm", "run"])
+    parser.add_argument('--dir', required=True, action="store", help='Result dir')
+    parser.add_argument('--db', required=True, action="store", help='Results database')
+    parser.add_argument('--name', action="store", help='Name of the run')
+    args = parser.parse_args(sys.argv[2:])
+
+    cfg = json.load(open(args.cfg)) if args.cfg else None
+    runcfg = json.load(open(args.runcfg)) if args.runcfg else None
+    commit = getGitCommit(cfg["src"]) if cfg and "src" in cfg else None
+
+    db = openResultsDB(args.db)
+    runid = ingestResults(db, args.dir, args.name, cfg, runcfg, commit)
+    print("Stored %s as run %d" % (args.dir, runid))
+
+  def history(self):
+    parser = argparse.ArgumentParser(description = """
+Shows runs stored at a results database, or the history of tests whose names
+contain --test.
+""")
+    addTraceArgument(parser)
+    parser.add_argument('--db', required=True, action="store", help='Results database')
+    parser.add_argument('--test', action="store", help='Substring of test names')
+    parser.add_argument('--metric', action="store", default="exec_time",
+                        help='Metric to show (default: exec_time)')
+    args = parser.parse_args(sys.argv[2:])
+
+    db = openResultsDB(args.db)
+    if not args.test:
+      for runid, name, time, machine, commit, path in listRuns(db):
+        print("%d\t%s\t%s\t%s\t%s\t%s" % (runid, name, time, machine, commit, path))
+      return
+
+    for runid, name, time, commit, testname, vals in testHistory(db, args.test, args.metric):
+      print("%s\t%d\t%s\t%s\t%s\tmedian=%s\t%s" %
+            (testname, runid, name, time, commit, median(vals), vals))
+
+
+
   ############################################################
   #                Running SPEC benchmarks
   ############################################################
@@ -1176,10 +2712,59 @@ The path of SPEC CPU should be given with --speccfg.
           n = jsonres[k][k2]
         jsonres[k][k2] = n + json[k][k2]
 
+  # Compiles instcounter.cpp with the LLVM at llvmdir. The binary is cached per
+  # (LLVM build, llvm-config --version, instcounter.cpp) and reused.
+  def _buildInstCounter(self, llvmdir, lcfg):
+    mydir = os.path.dirname(__file__)
+    src = os.path.join(mydir, "instcounter.cpp")
+
+    p = Popen([lcfg, "--version"], stdout=subprocess.PIPE)
+    out, err = p.communicate()
+    version = out.decode("utf-8").strip()
+
+    key = hashlib.sha1(("%s\n%s\n%s" % (os.path.abspath(llvmdir), version,
+                                         fileHash(src))).encode("utf-8")).hexdigest()
+    cachedir = getCacheDir("instcounter")
+    instcounter = os.path.join(cachedir, "instcounter-%s" % key[:16])
+    if os.path.exists(instcounter):
+      return instcounter
+
+    # Other processes may be compiling the same binary
+    with open(instcounter + ".lock", "w") as lockf:
+      fcntl.flock(lockf, fcntl.LOCK_EX)
+      if os.path.exists(instcounter):
+        return instcounter
+
+      # Let's compile instcounter.cpp
+      p = Popen([lcfg, "--cxxflags", "--ldflags", "--libs", "--system-libs"], stdout=subprocess.PIPE)
+      out, err = p.communicate()
+      cxxflags = out.decode("utf-8").split()
+
+      tmp = "%s.%d" % (instcounter, os.getpid())
+      p = Popen([os.path.join(llvmdir, "bin", "clang++"), "-std=c++11", src] +
+                cxxflags + ["-o", tmp])
+      p.wait()
+      if p.returncode != 0 or not os.path.exists(tmp):
+        print("%s not generated!" % instcounter)
+        exit(1)
+      os.replace(tmp, instcounter)
+    return instcounter
+
   def instcount(self):
     parser = newParser("instcount", llvm=True)
     parser.add_argument('--dir', help='A directory that contains *.bc files', action='store', required=True)
     parser.add_argument('--out', help='Output (as a json file)', action='store', required=True)
+    parser.add_argument('--core', help='# of processes to use', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--modules', help='Output of per-module results (as a json file)',
+                        action='store')
+    parser.add_argument('--nocache', help='Do not use cached per-module results',
+                        action='store_true')
+    parser.add_argument('--commit', action='store',
+        help='Use LLVM of this commit from build-cache instead of the builds '
+             'at cfg (built if it is not cached)')
+    parser.add_argument('--type', action='store',
+        help='Build type of --commit (default: the first one at cfg)')
     args = parser.parse_args(sys.argv[2:])
 
     if not os.path.exists(args.dir):
@@ -1195,49 +2780,108 @@ The path of SPEC CPU should be given with --speccfg.
     llvmdir = None
     lcfg = None
 
-    for k in cfg["builds"]:
-      p = cfg["builds"][k]["path"]
-      pcfg = os.path.join(p, "bin", "llvm-config")
-      if os.path.exists(pcfg):
-        llvmdir = p
-        lcfg = pcfg
-        break
+    if args.commit:
+      buildtype = args.type if args.type else list(cfg["builds"].keys())[0]
+      checkLLVMConfigForBuild(cfg, buildtype)
+      cfg = self._getCommitConfig(cfg, buildtype, args.commit, dev=True)
+      llvmdir = cfg["builds"][buildtype]["path"]
+      lcfg = os.path.join(llvmdir, "bin", "llvm-config")
+    else:
+      for k in cfg["builds"]:
+        p = cfg["builds"][k]["path"]
+        pcfg = os.path.join(p, "bin", "llvm-config")
+        if os.path.exists(pcfg):
+          llvmdir = p
+          lcfg = pcfg
+          break
 
     if not lcfg:
       print("Cannot find llvm-config")
       exit(1)
 
-    mydir = os.path.dirname(__file__)
-
-    # Let's compile instcounter.cpp
-    p = Popen([lcfg, "--cxxflags", "--ldflags", "--libs", "--system-libs"], stdout=subprocess.PIPE)
-    out, err = p.communicate()
-    cxxflags = out.decode("utf-8").split()
-
-    instcounter = "/tmp/instcounter"
-    p = Popen([os.path.join(llvmdir, "bin", "clang++"), "-std=c++11",
-               os.path.join(mydir, "instcounter.cpp")] + cxxflags +
-              ["-o", instcounter])
-    p.wait()
-    if not os.path.exists(instcounter):
-      print("%s not generated!" % instcounter)
-      exit(1)
+    instcounter = self._buildInstCounter(llvmdir, lcfg)
 
     # Now, let's traverse and accumulate the result!
     bcpaths = [os.path.join(dp, f)
                for dp, dn, filenames in os.walk(args.dir)
                for f in filenames if os.path.splitext(f)[-1] == '.bc']
 
-    #results = dict()
+    # Per-module results are cached by the content of .bc files and the
+    # instcounter binary, so only new or changed modules are analyzed.
+    cachedir = getCacheDir(os.path.join("instcount", os.path.basename(instcounter)))
+    _cachepath = lambda h: os.path.join(cachedir, h[:2], h + ".json")
+
+    corecnt = max(1, min(args.core, len(bcpaths)))
+    pool = multiprocessing.pool.ThreadPool(corecnt)
+    hashes = dict(zip(bcpaths, pool.map(fileHash, bcpaths)))
+
+    results = dict()
+    todo = []
+    for bcpath in bcpaths:
+      cachepath = _cachepath(hashes[bcpath])
+      if not args.nocache and os.path.exists(cachepath):
+        results[bcpath] = json.load(open(cachepath, "r"))
+      else:
+        todo.append(bcpath)
+    print("%d/%d files are cached" % (len(bcpaths) - len(todo), len(bcpaths)))
+
+    # Each instcounter process counts a shard of files given from stdin and
+    # prints one json object per line in order. If it crashes, the first file
+    # that is not printed is the one that crashed it, and the files after it
+    # are counted by a new process.
+    # Returns (the json objects, the files that crashed instcounter).
+    def _count(shard):
+      res = []
+      crashed = []
+      while len(shard) > 0:
+        p = Popen([instcounter, "--stdin"], stdin=subprocess.PIPE,
+                  stdout=subprocess.PIPE)
+        out, err = p.communicate("\n".join(shard).encode("utf-8"))
+        for l in out.decode("utf-8").splitlines():
+          try:
+            res.append(json.loads(l))
+          except ValueError:
+            # An empty line, or the last line cut by a crash
+            pass
+        printed = set([j["path"] for j in res])
+        left = [f for f in shard if f not in printed]
+        if len(left) > 0:
+          crashed.append(left[0])
+        shard = left[1:]
+      return res, crashed
+
+    shards = [todo[i::corecnt] for i in range(0, corecnt) if len(todo[i::corecnt]) > 0]
+    crashed = []
+    counted = 0
+    for js, crashed_ in pool.imap_unordered(_count, shards):
+      crashed = crashed + crashed_
+      for j in js:
+        bcpath = j.pop("path")
+        if "error" in j:
+          print("Cannot count %s" % bcpath)
+          continue
+        results[bcpath] = j
+        counted = counted + 1
+
+        cachepath = _cachepath(hashes[bcpath])
+        os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+        tmp = "%s.%d" % (cachepath, os.getpid())
+        json.dump(j, open(tmp, "w"))
+        os.replace(tmp, cachepath)
+    pool.close()
+    print("Counted %d files" % counted)
+    if len(crashed) > 0:
+      for bcpath in sorted(crashed):
+        print("instcounter crashed while counting %s" % bcpath)
+      exit(1)
+
     total = {"instrs":{}, "constexprs":{}, "intrinsics":{} }
     for bcpath in bcpaths:
-      print(bcpath)
-      p = Popen([instcounter, bcpath], stdout=subprocess.PIPE)
-      out, err = p.communicate()
-      t = out.decode("utf-8")
-      j = json.loads(t)
-      #results[bcpath] = j
-      self._instcount_sum(j, total)
+      if bcpath in results:
+        self._instcount_sum(results[bcpath], total)
+
+    if args.modules:
+      json.dump(results, open(args.modules, "w"), indent=2, sort_keys=True)
 
     total["path"] = args.dir
     total["instrs"]["total"] = sum([total["instrs"][k] for k in total["instrs"]])
@@ -1253,11 +2897,13 @@ The path of SPEC CPU should be given with --speccfg.
   ############################################################
   def filter(self):
     parser = argparse.ArgumentParser(description = 'Arguments for filter command')
-    parser.add_argument('--json', action="store",
+    addTraceArgument(parser)
+    parser.add_argument('--json', action="store", nargs='+',
         help='The result of test-suite run', required=True)
     parser.add_argument('--diff', action="store",
         help='Assembly diff file', required=True)
-    parser.add_argument('--out', help='Output file path', required=True,
+    parser.add_argument('--out', help='Output file path (or a directory if '
+                        'multiple --json files are given)', required=True,
                         action='store')
     args = parser.parse_args(sys.argv[2:])
 
@@ -1285,53 +2931,75 @@ The path of SPEC CPU should be given with --speccfg.
 
       diffs.append((filename, True if hasdiff == "YESDIFF" else False))
 
-    data = json.load(open(args.json, "r"))
-    results = data["tests"]
-    newresults = []
-
-    for i in range(0, len(results)):
-      rawname = results[i]["name"]
-
-      assert(rawname.startswith("test-suite :: "))
-      rawname = rawname[len("test-suite :: "):]
-      if not rawname.startswith("MicroBenchmarks"):
-        assert rawname.endswith(".test"), rawname
-      name = rawname[:rawname.rfind(".test")]
-
-      if name.startswith("SingleSource"):
-        # SingleSource/AA/TEST => SingleSource/AA/CMakeFiles/TEST.dir/test.extension
-        idx = name.rfind("/")
-        testname = name[name.rfind("/") + 1:]
-        newname = name[:idx] + "/CMakeFiles/" + testname + ".dir/" + testname
-        diffs_filtered = [x for x in diffs if x[0] == newname]
+    # Sort the file names once so that a prefix can be found with bisect
+    diffs.sort()
+    names = [x[0] for x in diffs]
+
+    def _withPrefix(prefix):
+      i = bisect.bisect_left(names, prefix)
+      j = i
+      while j < len(names) and names[j].startswith(prefix):
+        j = j + 1
+      return diffs[i:j]
+
+    def _equals(name):
+      i = bisect.bisect_left(names, name)
+      j = bisect.bisect_right(names, name)
+      return diffs[i:j]
+
+    def _filter(jsonpath, outpath):
+      data = json.load(open(jsonpath, "r"))
+      results = data["tests"]
+      newresults = []
+
+      for i in range(0, len(results)):
+        rawname = results[i]["name"]
+
+        assert(rawname.startswith("test-suite :: "))
+        rawname = rawname[len("test-suite :: "):]
+        if not rawname.startswith("MicroBenchmarks"):
+          assert rawname.endswith(".test"), rawname
+        name = rawname[:rawname.rfind(".test")]
+
+        if name.startswith("SingleSource"):
+          # SingleSource/AA/TEST => SingleSource/AA/CMakeFiles/TEST.dir/test.extension
+          idx = name.rfind("/")
+          testname = name[name.rfind("/") + 1:]
+          newname = name[:idx] + "/CMakeFiles/" + testname + ".dir/" + testname
+          diffs_filtered = _equals(newname)
+
+          if diffs_filtered == []:
+            # Remove the filename and retry
+            newname = newname[:newname.rfind("/")]
+            diffs_filtered = _withPrefix(newname)
+
+          assert(len(diffs_filtered) == 1)
 
-        if diffs_filtered == []:
-          # Remove the filename and retry
-          newname = newname[:newname.rfind("/")]
-          diffs_filtered = [x for x in diffs if x[0].startswith(newname)]
-
-        assert(len(diffs_filtered) == 1)
-
-      else:
-        # MultiSource/AA/TEST => MultiSource/AA/CMakeFiles/TEST.dir/*
-        idx = name.rfind("/")
-        testname = name[name.rfind("/") + 1:]
-        newname = name[:idx] + "/CMakeFiles/" + testname + ".dir/"
-        #print(newname)
-        diffs_filtered = [x for x in diffs if x[0].startswith(newname)]
-        assert(len(diffs_filtered) > 0)
-
-      #print(diffs_filtered)
-
-      hasdiff = False
-      for itm in diffs_filtered:
-        hasdiff = hasdiff or itm[1]
-      if hasdiff:
-        print("-- %s: HAS DIFF!" % rawname)
-        newresults.append(results[i])
-
-    data["tests"] = newresults
-    json.dump(data, open(args.out, "w"), indent=2)
+        else:
+          # MultiSource/AA/TEST => MultiSource/AA/CMakeFiles/TEST.dir/*
+          idx = name.rfind("/")
+          testname = name[name.rfind("/") + 1:]
+          newname = name[:idx] + "/CMakeFiles/" + testname + ".dir/"
+          diffs_filtered = _withPrefix(newname)
+          assert(len(diffs_filtered) > 0)
+
+        hasdiff = False
+        for itm in diffs_filtered:
+          hasdiff = hasdiff or itm[1]
+        if hasdiff:
+          print("-- %s: HAS DIFF!" % rawname)
+          newresults.append(results[i])
+
+      data["tests"] = newresults
+      json.dump(data, open(outpath, "w"), indent=2)
+
+    if len(args.json) == 1:
+      _filter(args.json[0], args.out)
+    else:
+      if not os.path.exists(args.out):
+        os.makedirs(args.out)
+      for jsonpath in args.json:
+        _filter(jsonpath, os.path.join(args.out, os.path.basename(jsonpath)))
 
 
 
@@ -1376,6 +3044,15 @@ The path of SPEC CPU should be given with --speccfg.
         _checkAttr("path" in cfg["builds"][build], "builds/%s/path" % build, fname, True)
         # sharedlib is not mandatory
 
+      if "clone-mode" in cfg and cfg["clone-mode"] not in ["worktree", "reference"]:
+        _errmsg(True, "clone-mode should be either \"worktree\" or \"reference\"")
+      if ("clone-mode" in cfg or "filter" in cfg) and getGitMirrorPath(cfg) == None:
+        _errmsg(False, "clone-mode and filter are used with mirror only.")
+      if "build-cache" in cfg and cfg["build-cache"] not in (True, False) and \
+         not isinstance(cfg["build-cache"], dict):
+        _errmsg(True, "build-cache should be true, false or {\"dir\": <path>, "
+                      "\"max-size-gb\": <size>}")
+
     if args.testcfg:
       fname = args.testcfg
       testcfg = json.load(open(fname))
@@ -1412,6 +3089,27 @@ The path of SPEC CPU should be given with --speccfg.
       if "emitbc" in runcfg:
         if not (runcfg["emitbc"] == "beforeopt" or runcfg["emitbc"] == "afteropt"):
           _errmsg(True, "emitbc should be either \"beforeopt\" or \"afteropt\"")
+      if "pin-cores" in runcfg:
+        pin = runcfg["pin-cores"]
+        if not (isinstance(pin, (bool, int)) or isinstance(pin, list)):
+          _errmsg(True, "pin-cores should be true, the number of cores or a list of CPUs")
+        elif not hasAndEquals(runcfg, "benchmark", True):
+          _errmsg(False, "pin-cores is used with \"benchmark\": true only.")
+        elif pin != False and len(self._getPinnedCPUs(runcfg)) == 0:
+          _errmsg(True, "No CPU is available for pin-cores.")
+      if "perf-events" in runcfg:
+        if not isinstance(runcfg["perf-events"], list):
+          _errmsg(True, "perf-events should be a list of perf events")
+        elif len(getSupportedPerfEvents(runcfg["perf-events"])) == 0:
+          _errmsg(False, "None of perf-events can be counted at this machine.")
+      if "generator" in runcfg and runcfg["generator"] not in ["make", "ninja"]:
+        _errmsg(True, "generator should be either \"make\" or \"ninja\"")
+      if hasAndEquals(runcfg, "emit-singlepass", True) and \
+         not (hasAndEquals(runcfg, "emitasm", True) or "emitbc" in runcfg):
+        _errmsg(False, "emit-singlepass is used with emitasm or emitbc only.")
+      if "compile-cache" in runcfg and runcfg["compile-cache"] != False and \
+         hasAndEquals(runcfg, "benchmark", "compiletime"):
+        _errmsg(False, "compile-cache is disabled when benchmarking compile-time.")
 
     if args.speccfg:
       fname = args.speccfg
@@ -0,0 +1,52 @@
+#!/bin/bash
+# Placeholders are replaced by _initRunUnderScript at run.py.
+# Runs the given command on the CPU of the lit worker that runs it. Each worker
+# takes one of CPUS when it runs its first benchmark and keeps it, so nothing
+# waits for a CPU here.
+# Only builtins are used before the command starts because timeit may time
+# this script as a part of the benchmark.
+CPUS="[[CPUS]]"
+STATEDIR=[[STATEDIR]] # The CPU of each worker (emptied before lit starts)
+LOG=[[LOG]]
+PERFEVENTS="[[PERFEVENTS]]" # Events counted by perf stat (empty: disabled)
+
+# The worker is the closest ancestor that is neither a shell nor timeit
+worker=$PPID
+while [ "$worker" -gt 1 ] && read -r comm < /proc/$worker/comm; do
+  case "$comm" in
+    sh|bash|dash|timeit|timeit-target) ;;
+    *) break ;;
+  esac
+  read -r stat < /proc/$worker/stat || break
+  stat=${stat##*) }
+  stat=${stat#* }
+  worker=${stat%% *}
+done
+
+if [ -f "$STATEDIR/worker$worker" ]; then
+  read -r cpu < "$STATEDIR/worker$worker"
+else
+  # With noclobber, creating cpuN fails if another worker took N
+  cpu=
+  set -o noclobber
+  for c in $CPUS; do
+    if { echo $worker > "$STATEDIR/cpu$c"; } 2>/dev/null; then
+      cpu=$c
+      break
+    fi
+  done
+  set +o noclobber
+  if [ -z "$cpu" ]; then
+    # There are more workers than CPUs
+    cpus=($CPUS)
+    cpu=${cpus[$((worker % ${#cpus[@]}))]}
+  fi
+  echo $cpu > "$STATEDIR/worker$worker"
+fi
+
+printf '%s\t%s\t%s\t%s\n' "$cpu" "$$" "$PWD" "$1" >> "$LOG"
+if [ -n "$PERFEVENTS" ]; then
+  # perf stat exits with the exit code of the command
+  exec taskset -c $cpu perf stat -x, -e "$PERFEVENTS" -o "$LOG.$$.perf" -- "$@"
+fi
+exec taskset -c $cpu "$@"
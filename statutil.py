@@ -0,0 +1,185 @@
+import itertools
+import math
+import random
+
+# numpy is optional; it only makes resampling faster.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+def median(runs):
+  s = sorted(runs)
+  l = len(s)
+  return s[l // 2] if l % 2 == 1 else (s[l // 2 - 1] + s[l // 2]) / 2
+
+def geomean(vals):
+  assert(len(vals) > 0)
+  return math.exp(sum([math.log(v) for v in vals]) / len(vals))
+
+# Speedup (%) of runs2 over runs1, which is the same as the one printed by
+# `run.py compare`
+def speedup(med1, med2):
+  return 0.0 if med2 == 0.0 else ((med1 - med2) / med2 * 100)
+
+def _percentile(sortedvals, q):
+  idx = q * (len(sortedvals) - 1)
+  lo = int(math.floor(idx))
+  hi = int(math.ceil(idx))
+  return sortedvals[lo] + (sortedvals[hi] - sortedvals[lo]) * (idx - lo)
+
+# Bootstrap confidence interval of the speedup of medians.
+# Returns (low, high).
+def bootstrapSpeedupCI(runs1, runs2, iterations=1000, confidence=0.95, seed=0):
+  alpha = (1.0 - confidence) / 2
+  if numpy is not None:
+    rng = numpy.random.default_rng(seed)
+    a1 = numpy.asarray(runs1, dtype=float)
+    a2 = numpy.asarray(runs2, dtype=float)
+    m1 = numpy.median(a1[rng.integers(0, len(a1), (iterations, len(a1)))], axis=1)
+    m2 = numpy.median(a2[rng.integers(0, len(a2), (iterations, len(a2)))], axis=1)
+    safe = numpy.where(m2 == 0.0, 1.0, m2)
+    s = numpy.where(m2 == 0.0, 0.0, (m1 - m2) / safe * 100)
+    lo, hi = numpy.quantile(s, [alpha, 1.0 - alpha])
+    return (float(lo), float(hi))
+
+  rng = random.Random(seed)
+  s = []
+  for i in range(0, iterations):
+    m1 = median([rng.choice(runs1) for x in runs1])
+    m2 = median([rng.choice(runs2) for x in runs2])
+    s.append(speedup(m1, m2))
+  s.sort()
+  return (_percentile(s, alpha), _percentile(s, 1.0 - alpha))
+
+# Half width of the bootstrap confidence interval of the median, relative to
+# the median.
+def bootstrapRelativeCI(runs, iterations=1000, confidence=0.95, seed=0):
+  med = median(runs)
+  if med == 0.0:
+    return 0.0
+  alpha = (1.0 - confidence) / 2
+  rng = random.Random(seed)
+  meds = sorted([median([rng.choice(runs) for x in runs])
+                 for i in range(0, iterations)])
+  return (_percentile(meds, 1.0 - alpha) - _percentile(meds, alpha)) / 2 / med
+
+# Bootstrap confidence interval of the change (%) of the geomean of the
+# medians of tests, from [(runs1, runs2), ...] of the tests. Runs of each
+# test are resampled. Returns (low, high).
+def bootstrapGeomeanChangeCI(samples, iterations=1000, confidence=0.95, seed=0):
+  alpha = (1.0 - confidence) / 2
+  rng = random.Random(seed)
+  s = []
+  for i in range(0, iterations):
+    ratios = []
+    for runs1, runs2 in samples:
+      m1 = median([rng.choice(runs1) for x in runs1])
+      m2 = median([rng.choice(runs2) for x in runs2])
+      ratios.append(m2 / m1 if m1 > 0.0 and m2 > 0.0 else 1.0)
+    s.append((geomean(ratios) - 1.0) * 100)
+  s.sort()
+  return (_percentile(s, alpha), _percentile(s, 1.0 - alpha))
+
+def _ranks(vals):
+  order = sorted(range(0, len(vals)), key=lambda i: vals[i])
+  ranks = [0.0] * len(vals)
+  i = 0
+  while i < len(order):
+    j = i
+    while j + 1 < len(order) and vals[order[j + 1]] == vals[order[i]]:
+      j = j + 1
+    for k in range(i, j + 1):
+      ranks[order[k]] = (i + j) / 2 + 1
+    i = j + 1
+  return ranks
+
+# Two-sided Mann-Whitney U test. Returns the p-value.
+# Small samples are tested exactly by enumerating all rank assignments.
+def mannWhitneyU(runs1, runs2, exactlimit=50000):
+  n1 = len(runs1)
+  n2 = len(runs2)
+  ranks = _ranks(list(runs1) + list(runs2))
+  r1 = sum(ranks[:n1])
+  mean = n1 * (n1 + n2 + 1) / 2
+
+  if math.comb(n1 + n2, n1) <= exactlimit:
+    observed = abs(r1 - mean)
+    total = 0
+    extreme = 0
+    for c in itertools.combinations(ranks, n1):
+      total = total + 1
+      if abs(sum(c) - mean) >= observed - 1e-9:
+        extreme = extreme + 1
+    return extreme / total
+
+  # Normal approximation with tie correction
+  n = n1 + n2
+  ties = {}
+  for r in ranks:
+    ties[r] = ties.get(r, 0) + 1
+  tiesum = sum([t ** 3 - t for t in ties.values()])
+  var = n1 * n2 / 12 * ((n + 1) - tiesum / (n * (n - 1)))
+  if var == 0:
+    return 1.0
+  z = (abs(r1 - mean) - 0.5) / math.sqrt(var)
+  return math.erfc(max(z, 0.0) / math.sqrt(2))
+
+# Speedup (%) of paired samples [(run1, run2), ...], which is the median of
+# the speedups of pairs
+def pairedSpeedup(pairs):
+  return speedup(median([a / b if b != 0.0 else 1.0 for a, b in pairs]), 1.0)
+
+# Bootstrap confidence interval of pairedSpeedup. Pairs are resampled
+# together. Returns (low, high).
+def bootstrapPairedSpeedupCI(pairs, iterations=1000, confidence=0.95, seed=0):
+  alpha = (1.0 - confidence) / 2
+  rng = random.Random(seed)
+  s = sorted([pairedSpeedup([rng.choice(pairs) for x in pairs])
+              for i in range(0, iterations)])
+  return (_percentile(s, alpha), _percentile(s, 1.0 - alpha))
+
+# Two-sided Wilcoxon signed-rank test of paired samples. Returns the p-value.
+# Pairs with no difference are dropped. Small samples are tested exactly.
+def wilcoxonSignedRank(pairs, exactlimit=50):
+  diffs = [a - b for a, b in pairs if a != b]
+  n = len(diffs)
+  if n == 0:
+    return 1.0
+  ranks = _ranks([abs(d) for d in diffs])
+  wplus = sum([r for r, d in zip(ranks, diffs) if d > 0])
+  mean = n * (n + 1) / 4
+
+  if n <= exactlimit:
+    # The distribution of the sum of (doubled, to make them integers) ranks
+    # over all sign assignments
+    dist = [1]
+    for r in ranks:
+      r2 = int(round(r * 2))
+      nd = dist + [0] * r2
+      for v in range(0, len(dist)):
+        nd[v + r2] = nd[v + r2] + dist[v]
+      dist = nd
+    observed = abs(wplus - mean) * 2
+    extreme = sum([c for v, c in enumerate(dist)
+                   if abs(v - mean * 2) >= observed - 1e-9])
+    return extreme / (2 ** n)
+
+  # Normal approximation with tie correction
+  ties = {}
+  for r in ranks:
+    ties[r] = ties.get(r, 0) + 1
+  tiesum = sum([t ** 3 - t for t in ties.values()])
+  var = n * (n + 1) * (2 * n + 1) / 24 - tiesum / 48
+  if var == 0:
+    return 1.0
+  z = (abs(wplus - mean) - 0.5) / math.sqrt(var)
+  return math.erfc(max(z, 0.0) / math.sqrt(2))
+
+# The suite a test belongs to (SingleSource, MultiSource, SPEC, ...)
+def suiteOf(testname):
+  if testname.startswith("test-suite :: "):
+    testname = testname[len("test-suite :: "):]
+  if testname.startswith("External/SPEC"):
+    return "SPEC"
+  return testname.split("/")[0]
@@ -0,0 +1,140 @@
+import argparse
+import atexit
+import json
+import os
+import subprocess
+import threading
+import time
+
+# Records phases of run.py (subprocesses started through Popen and blocks of
+# tracePhase) and writes them in Chrome trace event format, which can be
+# opened with chrome://tracing or https://ui.perfetto.dev .
+_tracer = None
+
+class _Tracer(object):
+  def __init__(self, path):
+    self.path = path
+    self.start = time.time()
+    self.events = []
+    self.lock = threading.Lock()
+    self.tids = dict()
+
+  def add(self, name, start, end, args):
+    with self.lock:
+      tid = self.tids.setdefault(threading.get_ident(), len(self.tids) + 1)
+      self.events.append({"name": name, "cat": "phase", "ph": "X",
+                          "ts": (start - self.start) * 1e6,
+                          "dur": (end - start) * 1e6,
+                          "pid": os.getpid(), "tid": tid, "args": args})
+
+  def write(self):
+    js = {"traceEvents": self.events, "displayTimeUnit": "ms"}
+    json.dump(js, open(self.path, "w"), indent=1)
+
+  def printSummary(self):
+    # Aggregate subprocesses by the program name
+    rows = dict()
+    for e in self.events:
+      r = rows.setdefault(e["name"], [0, 0.0, 0.0, 0])
+      r[0] = r[0] + 1
+      r[1] = r[1] + e["dur"] / 1e6
+      r[2] = r[2] + e["args"].get("utime", 0.0) + e["args"].get("stime", 0.0)
+      r[3] = max(r[3], e["args"].get("maxrss_kb", 0))
+
+    print("Trace is written to %s (%.1f sec.)" %
+          (self.path, time.time() - self.start))
+    print("%-24s %6s %12s %12s %14s" %
+          ("Phase", "Count", "Wall(sec.)", "CPU(sec.)", "Max RSS(MB)"))
+    for name, r in sorted(rows.items(), key=lambda x: -x[1][1]):
+      print("%-24s %6d %12.2f %12.2f %14.1f" %
+            (name[:24], r[0], r[1], r[2], r[3] / 1024))
+
+  def finish(self):
+    self.write()
+    self.printSummary()
+
+# Starts recording phases. The trace is written to path at exit.
+def startTracing(path):
+  global _tracer
+  _tracer = _Tracer(path)
+  atexit.register(_tracer.finish)
+
+class _TraceAction(argparse.Action):
+  def __call__(self, parser, namespace, values, option_string=None):
+    setattr(namespace, self.dest, values)
+    startTracing(values)
+
+# Adds --trace <path> to parser, which starts tracing when it is parsed
+def addTraceArgument(parser):
+  parser.add_argument('--trace', action=_TraceAction,
+      help='Record where time is spent to this file (Chrome trace format)')
+
+# Records the block as a phase: `with tracePhase("diff"): ...`
+class tracePhase(object):
+  def __init__(self, name, **args):
+    self.name = name
+    self.args = args
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if _tracer:
+      _tracer.add(self.name, self.start, time.time(), self.args)
+    return False
+
+# subprocess.Popen that records itself as a phase if tracing is on. The
+# process is reaped by a thread with wait4, which gives the exact end time and
+# the resource usage; wait() and poll() return what the thread got.
+class Popen(subprocess.Popen):
+  def __init__(self, args, *pargs, **kwargs):
+    self._traceStart = time.time()
+    self._reaper = None
+    super().__init__(args, *pargs, **kwargs)
+    if _tracer:
+      self._reaper = threading.Thread(target=self._reap, daemon=True)
+      self._reaper.start()
+
+  def _reap(self):
+    rusage = None
+    try:
+      pid, sts, rusage = os.wait4(self.pid, 0)
+      code = -os.WTERMSIG(sts) if os.WIFSIGNALED(sts) else os.WEXITSTATUS(sts)
+    except ChildProcessError:
+      # SIGCHLD is ignored; the exit status is unknown
+      code = 0
+    end = time.time()
+    self._record(end, rusage, code)
+    self.returncode = code
+
+  def wait(self, timeout=None):
+    if self._reaper == None:
+      return super().wait(timeout)
+    self._reaper.join(timeout)
+    if self._reaper.is_alive():
+      raise subprocess.TimeoutExpired(self.args, timeout)
+    return self.returncode
+
+  def poll(self):
+    if self._reaper == None:
+      return super().poll()
+    return self.returncode
+
+  def _record(self, end, rusage, returncode):
+    cmd = self.args if isinstance(self.args, (list, tuple)) else [self.args]
+    cmd = [os.fsdecode(c) for c in cmd]
+    targs = {"cmd": " ".join(cmd), "returncode": returncode}
+    if rusage:
+      targs["utime"] = rusage.ru_utime
+      targs["stime"] = rusage.ru_stime
+      targs["maxrss_kb"] = rusage.ru_maxrss
+    name = os.path.basename(cmd[0].split(" ")[0]) if len(cmd) > 0 else "?"
+    if name == "sudo":
+      # e.g. sudo -S sh -c "echo 1 > /proc/sys/vm/drop_caches"
+      rest = [c for c in cmd[1:] if not c.startswith("-")]
+      if len(rest) > 1 and rest[0] == "sh":
+        rest = rest[1].split(" ")
+      if len(rest) > 0:
+        name = "sudo " + os.path.basename(rest[0])
+    _tracer.add(name, self._traceStart, end, targs)